@@ -1,12 +1,5 @@
 import numpy as np
-import tensorflow as tf
-from tensorflow.keras import models
-from tensorflow.keras.layers import Dense
-from tensorflow.keras.optimizers import Adam
-#from keras.layers import Dense
-#from keras.optimizers import Adam
-from keras.models import Sequential
-from keras import backend as K
+import importlib
 from collections import deque
 import random
 import torch
@@ -21,15 +14,39 @@ import torch.optim as optim
 import torch.nn.functional as F
 import torch.nn as nn
 from torch.nn.utils import clip_grad_norm_
-from networks import Critic, Actor, DDQN_Net
+from federation import agent_parameters, vector_to_parameters_
+from networks import Critic, Actor, DDQN_Net, EnsembleCritic, soft_update
+from profiling import Profiler
 import math
 import copy
 
 
-
-
-
-tf.compat.v1.logging.set_verbosity(tf.compat.v1.logging.ERROR)
+# The TensorFlow/Keras agents are only imported when one of them is requested, so the DSAC
+# pipeline (and every worker process it spawns) starts with torch and NumPy only.
+KERAS_AGENTS = ('DQN', 'DDQN', 'A2C', 'DDPG', 'Random_Battery', 'Random')
+KERAS_AGENTS_MODULE = 'Agent_keras'
+
+
+def __getattr__(name):
+    if name in KERAS_AGENTS:
+        return load_agent_class(name)
+    raise AttributeError("module 'Agent' has no attribute " + repr(name))
+
+
+def load_agent_class(name):
+    """Returns the agent class of a _class_ML config value, importing TensorFlow only for the Keras agents."""
+    if name in globals():
+        return globals()[name]
+    if name not in KERAS_AGENTS:
+        raise ValueError('unknown _class_ML ' + repr(name))
+    try:
+        module = importlib.import_module(KERAS_AGENTS_MODULE)
+    except ImportError as e:
+        raise ImportError('_class_ML = ' + name + ' needs the TensorFlow/Keras agents of ' + KERAS_AGENTS_MODULE
+                          + '.py: ' + str(e)) from e
+    import tensorflow as tf
+    tf.compat.v1.logging.set_verbosity(tf.compat.v1.logging.ERROR)
+    return getattr(module, name)
 #os.environ["CUDA_VISIBLE_DEVICES"] = '1'
 
 
@@ -57,6 +74,7 @@ class DSAC:
         self.tau = 1e-2
         hidden_size = 256
         learning_rate = 5e-4
+        self.learning_rate = learning_rate
         self.clip_grad_param = 1
 
         self.target_entropy = -action_size  # -dim(A)
@@ -78,22 +96,18 @@ class DSAC:
         self.actor_local = Actor(state_size, action_size, hidden_size).to(device)
         self.actor_optimizer = optim.Adam(self.actor_local.parameters(), lr=learning_rate)
 
-        # Critic Network (w/ Target Network)
-
-        self.critic1 = Critic(state_size, action_size, hidden_size, 2).to(device)
-        self.critic2 = Critic(state_size, action_size, hidden_size, 1).to(device)
+        # Twin Critic Networks (w/ Target Network), stacked in one ensemble
 
-        assert self.critic1.parameters() != self.critic2.parameters()
+        self.critic = EnsembleCritic(state_size, action_size, hidden_size, 2).to(device)
 
-        self.critic1_target = Critic(state_size, action_size, hidden_size).to(device)
-        self.critic1_target.load_state_dict(self.critic1.state_dict())
+        self.critic_target = EnsembleCritic(state_size, action_size, hidden_size, 2).to(device)
+        self.critic_target.load_state_dict(self.critic.state_dict())
 
-        self.critic2_target = Critic(state_size, action_size, hidden_size).to(device)
-        self.critic2_target.load_state_dict(self.critic2.state_dict())
-
-        self.critic1_optimizer = optim.Adam(self.critic1.parameters(), lr=learning_rate)
-        self.critic2_optimizer = optim.Adam(self.critic2.parameters(), lr=learning_rate)
+        self.critic_optimizer = optim.Adam(self.critic.parameters(), lr=learning_rate)
+        self._zero = torch.zeros(1)
         self.softmax = nn.Softmax(dim=-1)
+        # replaced by the profiler of the house (Multi_Agent), disabled on its own
+        self.profiler = Profiler(agent_id)
 
     def get_action(self, state, eval=False):
         """Returns actions for given state as per current policy."""
@@ -103,17 +117,44 @@ class DSAC:
             action = self.actor_local.get_det_action(state)
         return action.numpy()
 
+    def state_dict(self):
+        """Everything needed to resume training: networks, optimizers and temperatures."""
+        return {'actor': self.actor_local.state_dict(),
+                'critic': self.critic.state_dict(),
+                'critic_target': self.critic_target.state_dict(),
+                'actor_optimizer': self.actor_optimizer.state_dict(),
+                'critic_optimizer': self.critic_optimizer.state_dict(),
+                'alpha_optimizer': self.alpha_optimizer.state_dict(),
+                'cql_alpha_optimizer': self.cql_alpha_optimizer.state_dict(),
+                'log_alpha': self.log_alpha.detach().clone(),
+                'cql_log_alpha': self.cql_log_alpha.detach().clone(),
+                'best_score': float(self.best_score)}
+
+    def load_state_dict(self, state):
+        """Restores a state_dict() in place, so the parameter lists of the federation stay bound."""
+        self.actor_local.load_state_dict(state['actor'])
+        self.critic.load_state_dict(state['critic'])
+        self.critic_target.load_state_dict(state['critic_target'])
+        self.actor_optimizer.load_state_dict(state['actor_optimizer'])
+        self.critic_optimizer.load_state_dict(state['critic_optimizer'])
+        self.alpha_optimizer.load_state_dict(state['alpha_optimizer'])
+        self.cql_alpha_optimizer.load_state_dict(state['cql_alpha_optimizer'])
+        with torch.no_grad():
+            self.log_alpha.copy_(state['log_alpha'])
+            self.cql_log_alpha.copy_(state['cql_log_alpha'])
+        self.alpha = self.log_alpha.exp().detach()
+        self.best_score = state['best_score']
+
     def calc_policy_loss(self, states, alpha):
         _, action_probs, log_pis = self.actor_local.evaluate(states)
 
-        q1 = self.critic1(states)
-        q2 = self.critic2(states)
-        min_Q = torch.min(q1, q2)
+        with torch.no_grad():
+            min_Q = self.critic(states).min(0)[0]
         actor_loss = (action_probs * (alpha.to(self.device) * log_pis - min_Q)).sum(1).mean()
         log_action_pi = torch.sum(log_pis * action_probs, dim=1)
         return actor_loss, log_action_pi
 
-    def learn(self, step, experiences, gamma, d=1):
+    def learn(self, step, experiences, gamma, d=1, weights=None):
         """Updates actor, critics and entropy_alpha parameters using given batch of experience tuples.
         Q_targets = r + γ * (min_critic_target(next_state, actor_target(next_state)) - α *log_pi(next_action|next_state))
         Critic_loss = MSE(Q, Q_target)
@@ -125,15 +166,19 @@ class DSAC:
         ======
             experiences (Tuple[torch.Tensor]): tuple of (s, a, r, s', done) tuples
             gamma (float): discount factor
+            weights (torch.Tensor): importance-sampling weights (batch, 1) of a prioritized replay,
+                the absolute TD errors of the batch are then left in self.td_errors
         """
         states, actions, rewards, next_states, dones = experiences
 
         # ---------------------------- update actor ---------------------------- #
-        current_alpha = copy.deepcopy(self.alpha)
+        # self.alpha is rebound, never modified in place, below: no copy needed
+        current_alpha = self.alpha
         actor_loss, log_pis = self.calc_policy_loss(states, current_alpha)
         self.actor_optimizer.zero_grad()
         actor_loss.backward()
         self.actor_optimizer.step()
+        self.profiler.lap('learn.actor_update')
 
         # Compute alpha loss
         alpha_loss = - (self.log_alpha.exp() * (log_pis.cpu() + self.target_entropy).detach().cpu()).mean()
@@ -141,34 +186,39 @@ class DSAC:
         alpha_loss.backward()
         self.alpha_optimizer.step()
         self.alpha = self.log_alpha.exp().detach()
+        self.profiler.lap('learn.alpha_update')
 
         # ---------------------------- update critic ---------------------------- #
         # Get predicted next-state actions and Q values from target models
         with torch.no_grad():
             _, action_probs, log_pis = self.actor_local.evaluate(next_states)
-            Q_target1_next = self.critic1_target(next_states)
-            Q_target2_next = self.critic2_target(next_states)
             Q_target_next = action_probs * (
-                        torch.min(Q_target1_next, Q_target2_next) - self.alpha.to(self.device) * log_pis)
+                        self.critic_target(next_states).min(0)[0] - self.alpha.to(self.device) * log_pis)
 
             # Compute Q targets for current states (y_i)
             Q_targets = rewards + (gamma * (1 - dones) * Q_target_next.sum(dim=1).unsqueeze(-1))
 
             # Compute critic loss
-        q1 = self.critic1(states)
-        q2 = self.critic2(states)
+        q1, q2 = self.critic(states)
 
         q1_ = q1.gather(1, actions.long())
         q2_ = q2.gather(1, actions.long())
 
-        critic1_loss = 0.5 * F.mse_loss(q1_, Q_targets)
-        critic2_loss = 0.5 * F.mse_loss(q2_, Q_targets)
+        if weights is None:
+            critic1_loss = 0.5 * F.mse_loss(q1_, Q_targets)
+            critic2_loss = 0.5 * F.mse_loss(q2_, Q_targets)
+        else:
+            td1 = q1_ - Q_targets
+            td2 = q2_ - Q_targets
+            critic1_loss = 0.5 * (weights * td1.pow(2)).mean()
+            critic2_loss = 0.5 * (weights * td2.pow(2)).mean()
+            self.td_errors = (0.5 * (td1.abs() + td2.abs())).detach().cpu().numpy()
 
         cql1_scaled_loss = torch.logsumexp(q1, dim=1).mean() - q1.mean()
         cql2_scaled_loss = torch.logsumexp(q2, dim=1).mean() - q2.mean()
 
-        cql_alpha_loss = torch.FloatTensor([0.0])
-        cql_alpha = torch.FloatTensor([0.0])
+        cql_alpha_loss = self._zero
+        cql_alpha = self._zero
         if self.with_lagrange:
             cql_alpha = torch.clamp(self.cql_log_alpha.exp(), min=0.0, max=1000000.0).to(self.device)
             cql1_scaled_loss = cql_alpha * (cql1_scaled_loss - self.target_action_gap)
@@ -182,24 +232,38 @@ class DSAC:
         total_c1_loss = critic1_loss + cql1_scaled_loss
         total_c2_loss = critic2_loss + cql2_scaled_loss
 
-        # Update critics
-        # critic 1
-        self.critic1_optimizer.zero_grad()
-        total_c1_loss.backward(retain_graph=True)
-        clip_grad_norm_(self.critic1.parameters(), self.clip_grad_param)
-        self.critic1_optimizer.step()
-        # critic 2
-        self.critic2_optimizer.zero_grad()
-        total_c2_loss.backward()
-        clip_grad_norm_(self.critic2.parameters(), self.clip_grad_param)
-        self.critic2_optimizer.step()
+        # Update both critics with one backward and one optimizer step, the members do not share parameters
+        self.critic_optimizer.zero_grad()
+        (total_c1_loss + total_c2_loss).backward()
+        self.critic.clip_grad_norm_(self.clip_grad_param)
+        self.critic_optimizer.step()
+        self.profiler.lap('learn.critic_update')
 
         # ----------------------- update target networks ----------------------- #
-        self.soft_update(self.critic1, self.critic1_target)
-        self.soft_update(self.critic2, self.critic2_target)
+        self.soft_update(self.critic, self.critic_target)
+        self.profiler.lap('learn.soft_update')
 
         return actor_loss.item(), alpha_loss.item(), critic1_loss.item(), critic2_loss.item(), cql1_scaled_loss.item(), cql2_scaled_loss.item(), current_alpha, cql_alpha_loss.item(), cql_alpha.item()
 
+    def learn_block(self, step, experiences, gamma, weights=None):
+        """Runs one learn() update per batch of a pre-sampled block of experiences.
+        Params
+        ======
+            experiences (Tuple[torch.Tensor]): tuple of (s, a, r, s', done) tensors of shape (n_batches, batch, ...)
+            gamma (float): discount factor
+            weights (torch.Tensor): importance-sampling weights (n_batches, batch, 1) of a prioritized replay,
+                the absolute TD errors of the block are then left in self.td_errors
+        """
+        td_errors = []
+        for k in range(experiences[0].shape[0]):
+            out = self.learn(step, tuple(e[k] for e in experiences), gamma,
+                             weights=None if weights is None else weights[k])
+            if weights is not None:
+                td_errors.append(self.td_errors)
+        if weights is not None:
+            self.td_errors = np.stack(td_errors)
+        return out
+
     def soft_update(self, local_model, target_model):
         """Soft update model parameters.
         θ_target = τ*θ_local + (1 - τ)*θ_target
@@ -209,9 +273,10 @@ class DSAC:
             target_model: PyTorch model (weights will be copied to)
             tau (float): interpolation parameter
         """
-        for target_param, local_param in zip(target_model.parameters(), local_model.parameters()):
-            target_param.data.copy_(self.tau * local_param.data + (1.0 - self.tau) * target_param.data)
+        soft_update(local_model, target_model, self.tau)
 
     ##############################################################################
     def update_agent_network(self, weights):
-        self.train_network.set_weights(weights)
+        """Loads a flat parameter vector of the federation (see federation.agent_parameters) in place."""
+        with torch.no_grad():
+            vector_to_parameters_(weights, agent_parameters(self))
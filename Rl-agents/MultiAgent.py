@@ -1,12 +1,12 @@
+import os
 import numpy as np
-from keras import models
-from tensorflow.keras.optimizers import Adam
 from random import randrange
 from collections import deque
 import torch
-from buffer import ReplayBuffer
+from buffer import ReplayBuffer, PrioritizedReplayBuffer
+from profiling import Profiler
 import glob
-from utils import save, collect_random
+from utils import save, collect_random, config_int
 import random
 
 
@@ -22,22 +22,58 @@ class Multi_Agent:
         self.len_episode = int(self.config.get('DRL', 'Max_Episode'))
         self.agents = agent_class(self.env, config, self.agent_id)
         self.drl_class = self.config.get('DRL', '_class_ML')
+        self.prioritized_replay = self.config.getboolean('DRL', 'Prioritized_Replay', fallback=False)
+        # update-to-data ratio: gradient_steps updates every learn_every env steps, after n_warmup random steps
+        self.n_warmup = config_int(self.config, 'DRL', 'n_warmup', 1000, minimum=0)
+        self.gradient_steps = config_int(self.config, 'DRL', 'gradient_steps', 1, minimum=1)
+        self.learn_every = config_int(self.config, 'DRL', 'learn_every', 1, minimum=1)
+        self.warmed_up = False
+        # metrics.MetricsSink recording the steps and episodes, set by the training loop
+        self.metrics = None
+        # per-phase timing of run() and of the DSAC updates, shared with the agent
+        self.profiler = Profiler(agent_id, enabled=self.config.getboolean('DRL', 'profile', fallback=False),
+                                 trace=bool(self.config.get('DRL', 'profile_trace', fallback='').strip()))
+        if hasattr(self.agents, 'profiler'):
+            self.agents.profiler = self.profiler
+        # the replay buffer lives as long as the agent, across federation episodes
+        self.buffer = None
+        if self.drl_class == 'DSAC':
+            device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+            if self.prioritized_replay:
+                self.buffer = PrioritizedReplayBuffer(buffer_size=100_000, batch_size=256, device=device,
+                                                      alpha=float(self.config.get('DRL', 'per_alpha', fallback=0.6)),
+                                                      beta=float(self.config.get('DRL', 'per_beta', fallback=0.4)))
+            else:
+                self.buffer = ReplayBuffer(buffer_size=100_000, batch_size=256, device=device)
+
+    def buffer_path(self, directory):
+        return os.path.join(directory, 'buffer_' + str(self.agent_id) + '.npz')
+
+    def save_buffer(self, directory):
+        """Snapshot the replay buffer to directory."""
+        os.makedirs(directory, exist_ok=True)
+        self.buffer.save(self.buffer_path(directory))
+
+    def load_buffer(self, directory):
+        """Restore the replay buffer from directory. Returns False if there is no snapshot."""
+        path = self.buffer_path(directory)
+        if not os.path.exists(path):
+            return False
+        self.buffer.load(path)
+        self.warmed_up = len(self.buffer) > 0
+        return True
 
     def run(self):
-        score_log = []
-        diffpro_log = []
-        battery_log = []
-        list_r=[]
+        # running sums of the episode, the steps themselves go to self.metrics
+        diffpro_sum = 0.0
+        battery_sum = 0.0
         done = False
         score = 0
-        state = self.env.reset()
-        state = np.reshape(state, [1, self.env.observation_space.shape[0]])
         steps = 0
         steps_ = 0
         eps = 1.
         d_eps = 1 - 0.01 #Minimal Epsilon
         if self.drl_class == 'DSAC':
-            state = self.env.reset()
             '''
             np.random.seed(1)
             random.seed(1)
@@ -45,15 +81,22 @@ class Multi_Agent:
             self.env.seed(1)
             self.env.action_space.seed(1)
             '''
-            buffer = ReplayBuffer(buffer_size=100_000, batch_size=256,
-                              device=torch.device("cuda:0" if torch.cuda.is_available() else "cpu"))
-            collect_random(env=self.env, dataset=buffer, num_samples=1000)
+            buffer = self.buffer
+            if not self.warmed_up:
+                collect_random(env=self.env, dataset=buffer, num_samples=self.n_warmup)
+                self.warmed_up = True
+        # one reset per episode, after the warm-up: with episode_windows every reset draws a new window of data
+        state = self.env.reset()
+        if self.drl_class != 'DSAC':
+            state = np.reshape(state, [1, self.env.observation_space.shape[0]])
         
 
 
 
 
 
+        prof = self.profiler
+        prof.mark()
         while not done:
             # get action for the current state and go one step in environment
             
@@ -61,13 +104,29 @@ class Multi_Agent:
                 action = self.agents.get_action(state)
                 steps += 1
                 #action = randrange(2)
+                prof.lap('get_action')
 
                 next_state, reward, done, info = self.env.step(action)
+                prof.lap('env.step')
                 buffer.add(state, action, reward, next_state, done)
-                self.agents.learn(steps, buffer.sample(), gamma=0.99)
+                prof.lap('buffer.add')
+                if steps % self.learn_every == 0:
+                    if self.prioritized_replay:
+                        experiences, weights, idx = buffer.sample(self.gradient_steps)
+                        prof.lap('buffer.sample')
+                        self.agents.learn_block(steps, experiences, gamma=0.99, weights=weights)
+                        buffer.update_priorities(idx, self.agents.td_errors)
+                        prof.lap('buffer.update_priorities')
+                    else:
+                        experiences = buffer.sample(self.gradient_steps)
+                        prof.lap('buffer.sample')
+                        self.agents.learn_block(steps, experiences, gamma=0.99)
                 state = next_state
                 score += reward
-                list_r.append(reward)
+                if self.metrics is not None:
+                    self.metrics.log_step(self.agent_id, steps, action, reward, info.get('dic_diffpro'),
+                                          info.get('dic_battery'))
+                prof.lap('metrics')
                 
 
 
@@ -75,19 +134,18 @@ class Multi_Agent:
 
             
 
-            diffpro_log.append(info.get('dic_diffpro'))
-            battery_log.append(info.get('dic_battery'))
+            diffpro_sum += info.get('dic_diffpro')
+            battery_sum += info.get('dic_battery')
 
 
 
 
             if done:
 
-                self.agents.avg_reward_per_house.append(np.mean(list_r))
-                print("step------------------------------", steps)
-              
+                self.agents.avg_reward_per_house.append(score / steps)
+                if self.metrics is not None:
+                    self.metrics.log_episode(self.agent_id, steps, score, diffpro_sum, battery_sum)
 
                 self.agents.best_score = score
-                #self.agents.best_score = np.mean(list_r)
-                self.agents.best_diffpro = np.mean(diffpro_log)
-                self.agents.best_battery = np.mean(battery_log)
\ No newline at end of file
+                self.agents.best_diffpro = diffpro_sum / steps
+                self.agents.best_battery = battery_sum / steps
\ No newline at end of file
@@ -0,0 +1,223 @@
+# python3 benchmarks/hot_path.py [--config Config_house/Progressus.properties] [--data Data/select_train_data_30m.csv]
+#                                [--output bench.json] [--baseline bench_baseline.json --tolerance 0.15] [--quick]
+# Regression benchmarks of the training hot path: env step, replay buffer add/sample at several
+# fill levels, DSAC.learn, get_action and a full Multi_Agent.run episode.
+# The benchmarks always run DSAC on the --data file, whatever _class_ML and envTrain the config gives.
+# The results are written as JSON; with --baseline every metric is compared to a stored result
+# and the exit status is 1 if any of them regressed by more than the tolerance.
+import argparse
+import configparser
+import datetime
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import numpy as np
+import torch
+
+RL_AGENTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, RL_AGENTS)
+
+
+def timed(fn, number, repeat):
+    """Best over repeat runs of the seconds per call of fn, called number times per run.
+    The minimum is the least disturbed by the rest of the machine, which keeps comparisons stable."""
+    fn()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        times.append((time.perf_counter() - start) / number)
+    return min(times)
+
+
+def metric(value, unit, higher_is_better):
+    return {'value': value, 'unit': unit, 'higher_is_better': higher_is_better}
+
+
+def bench_env(configfile, n_steps, repeat):
+    from house import ProgressusEnv, VecProgressusEnv
+    results = {}
+    env = ProgressusEnv(global_seed=0, configfile=configfile, agent_id=0, n_agents=1)
+    env.reset()
+    actions = np.random.randint(0, 5, size=n_steps)
+    it = iter(())
+
+    def step():
+        nonlocal it
+        try:
+            a = next(it)
+        except StopIteration:
+            it = iter(actions)
+            a = next(it)
+        env.step(int(a))
+    results['env.step'] = metric(1.0 / timed(step, n_steps, repeat), 'steps/s', True)
+
+    n_house = 32
+    vec_env = VecProgressusEnv(global_seed=0, configfile=configfile, n_agents=n_house)
+    vec_env.reset()
+    results['vec_env.step (32 houses)'] = metric(
+        n_house / timed(lambda: vec_env.step(vec_env.sample_actions()), max(1, n_steps // 10), repeat),
+        'house-steps/s', True)
+    return results
+
+
+def bench_buffer(buffer_size, fill_levels, number, repeat):
+    from buffer import ReplayBuffer, PrioritizedReplayBuffer
+    results = {}
+    for name, cls in (('ReplayBuffer', ReplayBuffer), ('PrioritizedReplayBuffer', PrioritizedReplayBuffer)):
+        buffer = cls(buffer_size=buffer_size, batch_size=256, device=torch.device('cpu'))
+        state = np.random.rand(4).astype(np.float32)
+        results[name + '.add'] = metric(1e6 * timed(lambda: buffer.add(state, 1, 0.5, state, False), number, repeat),
+                                        'us', False)
+        for fill in fill_levels:
+            n = min(fill, buffer_size) - len(buffer)
+            if n > 0:
+                buffer.add_batch(np.random.rand(n, 4).astype(np.float32), np.random.randint(0, 5, n),
+                                 np.random.rand(n).astype(np.float32), np.random.rand(n, 4).astype(np.float32),
+                                 np.zeros(n, dtype=np.float32))
+            results['{}.sample (fill {})'.format(name, len(buffer))] = metric(
+                1e6 * timed(buffer.sample, number, repeat), 'us', False)
+    return results
+
+
+def bench_agent(configfile, config, n_updates, number, repeat):
+    import gym
+    from Agent import DSAC
+    from buffer import ReplayBuffer
+    from house import registration
+    from utils import collect_random
+    registration(int(config.get('DRL', 'Max_Episode')))
+    env = gym.make('Progressus-v0', global_seed=0, configfile=configfile, agent_id=0, n_agents=1)
+    agent = DSAC(env, config, 0)
+    buffer = ReplayBuffer(buffer_size=100_000, batch_size=256, device=agent.device)
+    collect_random(env, buffer, num_samples=2000)
+    state = env.reset()
+    batches = [buffer.sample() for _ in range(16)]
+    k = iter(())
+
+    def learn():
+        nonlocal k
+        try:
+            batch = next(k)
+        except StopIteration:
+            k = iter(batches)
+            batch = next(k)
+        agent.learn(1, batch, gamma=0.99)
+    return {'DSAC.learn': metric(1.0 / timed(learn, n_updates, repeat), 'updates/s', True),
+            'DSAC.get_action': metric(1e6 * timed(lambda: agent.get_action(state), number, repeat), 'us', False)}
+
+
+def bench_episode(configfile, config, n_steps, repeat):
+    import gym
+    from Agent import DSAC
+    from MultiAgent import Multi_Agent
+    from house import registration
+    config.set('DRL', 'Max_Episode', str(n_steps))
+    registration(n_steps)
+    env = gym.make('Progressus-v0', global_seed=0, configfile=configfile, agent_id=0, n_agents=1)
+    agent = Multi_Agent(DSAC, env, config, 'benchmark', 0)
+    agent.run()  # random warm-up of the buffer, not timed
+    return {'Multi_Agent.run ({} steps)'.format(n_steps): metric(timed(agent.run, 1, repeat), 's', False)}
+
+
+def benchmark_config(configfile, data, directory):
+    """Copy of configfile in directory with the settings the benchmarks depend on: DSAC trained on
+    the memory-mapped data file. The environments read their config from a file, hence the copy.
+    Returns the config and the path of the copy."""
+    config = configparser.RawConfigParser(defaults=None, strict=False)
+    config.read(configfile)
+    config.set('DRL', '_class_ML', 'DSAC')
+    config.set('Simulation', 'envTrain', data)
+    config.remove_option('Simulation', 'envTrain_files')
+    path = os.path.join(directory, 'benchmark.properties')
+    with open(path, 'w') as f:
+        config.write(f)
+    return config, path
+
+
+def run(args):
+    os.chdir(RL_AGENTS)
+    np.random.seed(0)
+    torch.manual_seed(0)
+    scale = 10 if args.quick else 1
+    repeat = 3 if args.quick else 5
+
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        config, configfile = benchmark_config(args.config, args.data, directory)
+        results.update(bench_env(configfile, 20_000 // scale, repeat))
+        results.update(bench_buffer(100_000, [1_000, 10_000, 100_000], 2_000 // scale, repeat))
+        results.update(bench_agent(configfile, config, 200 // scale, 2_000 // scale, repeat))
+        results.update(bench_episode(configfile, config, 200 // scale, max(1, repeat // 2)))
+    return {'meta': {'date': datetime.datetime.now().isoformat(timespec='seconds'),
+                     'python': platform.python_version(), 'platform': platform.platform(),
+                     'cpu_count': os.cpu_count(), 'torch': torch.__version__, 'numpy': np.__version__,
+                     'torch_threads': torch.get_num_threads(), 'quick': args.quick,
+                     'data': os.path.basename(args.data)},
+            'results': results}
+
+
+def compare(current, baseline, tolerance):
+    """Prints current against baseline. Returns the names of the metrics worse by more than tolerance."""
+    regressions = []
+    for key in ('quick', 'data', 'cpu_count', 'torch_threads', 'torch'):
+        if current['meta'].get(key) != baseline['meta'].get(key):
+            print('warning: {} differs from the baseline ({} vs {})'.format(
+                key, current['meta'].get(key), baseline['meta'].get(key)))
+    print('{:<44s} {:>14s} {:>14s} {:>9s}'.format('benchmark', 'baseline', 'current', 'change'))
+    for name, cur in current['results'].items():
+        base = baseline['results'].get(name)
+        if base is None:
+            print('{:<44s} {:>14s} {:>14.4g} {:>9s}'.format(name, '-', cur['value'], 'new'))
+            continue
+        # > 0 is an improvement whatever the direction of the metric
+        change = cur['value'] / base['value'] - 1 if cur['higher_is_better'] else base['value'] / cur['value'] - 1
+        flag = ''
+        if change < -tolerance:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print('{:<44s} {:>14.4g} {:>14.4g} {:>+8.1f}%{} ({})'.format(name, base['value'], cur['value'], 100 * change,
+                                                                     flag, cur['unit']))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', type=str, default='Config_house/Progressus.properties')
+    parser.add_argument('--data', type=str, default='Data/select_train_data_30m.csv',
+                        help='dataset the environments step through (envTrain)')
+    parser.add_argument('--output', type=str, default=None, help='JSON file the results are written to')
+    parser.add_argument('--baseline', type=str, default=None, help='JSON results of an earlier run to compare to')
+    parser.add_argument('--tolerance', type=float, default=0.15, help='relative slowdown flagged as a regression')
+    parser.add_argument('--quick', action='store_true', help='10x fewer iterations, for a smoke test')
+    args = parser.parse_args()
+    # resolve the paths before run() moves to the Rl-agents directory
+    if os.path.exists(args.config):
+        args.config = os.path.abspath(args.config)
+    if os.path.exists(args.data):
+        args.data = os.path.abspath(args.data)
+    output = os.path.abspath(args.output) if args.output else None
+    baseline = os.path.abspath(args.baseline) if args.baseline else None
+
+    current = run(args)
+    if output:
+        with open(output, 'w') as f:
+            json.dump(current, f, indent=2)
+    if baseline:
+        with open(baseline) as f:
+            regressions = compare(current, json.load(f), args.tolerance)
+        if regressions:
+            print('{} regression(s) beyond {:.0f}%: {}'.format(len(regressions), 100 * args.tolerance,
+                                                               ', '.join(regressions)))
+            sys.exit(1)
+    else:
+        for name, m in current['results'].items():
+            print('{:<44s} {:>14.4g} {}'.format(name, m['value'], m['unit']))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,38 @@
+# python3 benchmarks/soft_update.py
+# Micro-benchmark of the DSAC target update: legacy per-parameter copy_ loop vs fused in-place lerp.
+import os
+import sys
+import timeit
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from networks import EnsembleCritic
+
+
+def soft_update_legacy(local_model, target_model, tau):
+    for target_param, local_param in zip(target_model.parameters(), local_model.parameters()):
+        target_param.data.copy_(tau * local_param.data + (1.0 - tau) * target_param.data)
+
+
+def soft_update_fused(local_model, target_model, tau):
+    torch._foreach_lerp_([p.data for p in target_model.parameters()],
+                         [p.data for p in local_model.parameters()], tau)
+
+
+def main(number=2000, hidden_size=256):
+    local = EnsembleCritic(4, 5, hidden_size, 2)
+    target = EnsembleCritic(4, 5, hidden_size, 2)
+    alpha = torch.tensor([1.0])
+    results = {
+        'soft_update (copy_ loop)': timeit.timeit(lambda: soft_update_legacy(local, target, 1e-2), number=number),
+        'soft_update (foreach lerp)': timeit.timeit(lambda: soft_update_fused(local, target, 1e-2), number=number),
+        'alpha deepcopy': timeit.timeit(lambda: __import__('copy').deepcopy(alpha), number=number),
+        'alpha constants (FloatTensor x2)': timeit.timeit(lambda: (torch.FloatTensor([0.0]), torch.FloatTensor([0.0])),
+                                                         number=number),
+    }
+    for name, t in results.items():
+        print('{:<36s}{:10.2f} us/call'.format(name, t / number * 1e6))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,45 @@
+# python3 benchmarks/startup.py [--repeat 5]
+# Startup time of main.py: wall time of `python main.py --help` (every import, no training),
+# and of the heavy imports it used to pay, for comparison.
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+RL_AGENTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+
+def wall_time(cmd, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = subprocess.run(cmd, cwd=RL_AGENTS, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        if result.returncode != 0:
+            return None
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    cases = [
+        ('python (empty)', [sys.executable, '-c', 'pass']),
+        ('import torch, numpy', [sys.executable, '-c', 'import torch, numpy']),
+        ('main.py --help', [sys.executable, 'main.py', '--help']),
+        ('import tensorflow', [sys.executable, '-c', 'import tensorflow']),
+    ]
+    for name, cmd in cases:
+        times = wall_time(cmd, args.repeat)
+        if times is None:
+            print('{:<24s} failed (not installed?)'.format(name))
+            continue
+        print('{:<24s} median {:7.3f} s   min {:7.3f} s'.format(name, statistics.median(times), min(times)))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,55 +1,408 @@
+import os
 import numpy as np
-import random
 import torch
-from collections import deque, namedtuple
+
 
 class ReplayBuffer:
-    """Fixed-size buffer to store experience tuples."""
+    """Fixed-size ring buffer to store experience tuples in preallocated arrays."""
 
-    def __init__(self, buffer_size, batch_size, device):
+    def __init__(self, buffer_size, batch_size, device, share_next_state=False):
         """Initialize a ReplayBuffer object.
         Params
         ======
             buffer_size (int): maximum size of buffer
             batch_size (int): size of each training batch
-            seed (int): random seed
+            device (torch.device): device of the sampled tensors
+            share_next_state (bool): store next_state by index, as the state of the following slot,
+                instead of duplicating it. Transitions must then be added in trajectory order; a
+                transition whose next_state is not the state of the following add is never sampled.
         """
         self.device = device
-        self.memory = deque(maxlen=buffer_size)
+        self.buffer_size = buffer_size
         self.batch_size = batch_size
-        self.experience = namedtuple("Experience", field_names=["state", "action", "reward", "next_state", "done"])
+        self.share_next_state = share_next_state
+        self.pos = 0
+        self.size = 0
+        self.states = None
+        # transitions added since creation, and (directory, n_added) of the last save_memmap
+        self.n_added = 0
+        self._saved = None
+
+    def _allocate(self, state):
+        state_shape = np.shape(state)
+        self.states = np.zeros((self.buffer_size,) + state_shape, dtype=np.float32)
+        self.actions = np.zeros((self.buffer_size, 1), dtype=np.int64)
+        self.rewards = np.zeros((self.buffer_size, 1), dtype=np.float32)
+        self.dones = np.zeros((self.buffer_size, 1), dtype=np.float32)
+        if self.share_next_state:
+            self.valid = np.zeros(self.buffer_size, dtype=bool)
+        else:
+            self.next_states = np.zeros((self.buffer_size,) + state_shape, dtype=np.float32)
+        self._bind_tensors()
+
+    def _bind_tensors(self):
+        # tensors sharing memory with the arrays, so a batch is gathered with one index_select each
+        self._states_t = torch.from_numpy(self.states)
+        self._actions_t = torch.from_numpy(self.actions)
+        self._rewards_t = torch.from_numpy(self.rewards)
+        self._dones_t = torch.from_numpy(self.dones)
+        if not self.share_next_state:
+            self._next_states_t = torch.from_numpy(self.next_states)
 
     def add(self, state, action, reward, next_state, done):
         """Add a new experience to memory."""
-        e = self.experience(state, action, reward, next_state, done)
-        self.memory.append(e)
-    '''
-    def sample(self):
-        """Randomly sample a batch of experiences from memory."""
-        experiences = random.sample(self.memory, k=self.batch_size)
+        if self.states is None:
+            self._allocate(state)
+        pos = self.pos
+        if self.share_next_state:
+            # slot pos holds the next_state of the previous transition
+            if self.size > 0 and not np.array_equal(self.states[pos], state):
+                self.valid[pos - 1] = False
+            self.valid[pos] = True
+            nxt = (pos + 1) % self.buffer_size
+            self.states[nxt] = next_state
+            self.valid[nxt] = False
+        else:
+            self.next_states[pos] = next_state
+        self.states[pos] = state
+        self.actions[pos] = action
+        self.rewards[pos] = reward
+        self.dones[pos] = done
+        self.pos = (pos + 1) % self.buffer_size
+        self.size = min(self.size + 1, self.buffer_size)
+        self.n_added += 1
 
-        states = torch.from_numpy(np.stack([e.state for e in experiences if e is not None])).float().to(self.device)
-        actions = torch.from_numpy(np.vstack([e.action for e in experiences if e is not None])).float().to(self.device)
-        rewards = torch.from_numpy(np.vstack([e.reward for e in experiences if e is not None])).float().to(self.device)
-        next_states = torch.from_numpy(np.stack([e.next_state for e in experiences if e is not None])).float().to(self.device)
-        dones = torch.from_numpy(np.vstack([e.done for e in experiences if e is not None]).astype(np.uint8)).float().to(self.device)
+    def add_batch(self, states, actions, rewards, next_states, dones):
+        """Add a batch of consecutive experiences to memory with one write per field.
+        Returns the slots the experiences were written to."""
+        if self.share_next_state:
+            slots = []
+            for e in zip(states, actions, rewards, next_states, dones):
+                slots.append(self.pos)
+                self.add(*e)
+            return np.array(slots, dtype=np.int64)
+        if self.states is None:
+            self._allocate(states[0])
+        n = len(states)
+        keep = slice(max(0, n - self.buffer_size), n)
+        slots = (self.pos + np.arange(n)[keep]) % self.buffer_size
+        self.states[slots] = states[keep]
+        self.actions[slots] = np.reshape(actions, (n, 1))[keep]
+        self.rewards[slots] = np.reshape(rewards, (n, 1))[keep]
+        self.next_states[slots] = next_states[keep]
+        self.dones[slots] = np.reshape(dones, (n, 1))[keep]
+        self.pos = (self.pos + n) % self.buffer_size
+        self.size = min(self.size + n, self.buffer_size)
+        self.n_added += n
+        return slots
 
-        return (states, actions, rewards, next_states, dones)
-    '''
-    def sample(self):
-        """Randomly sample a batch of experiences from memory."""
-        experiences = random.sample(self.memory, k=self.batch_size)
+    def _arrays(self):
+        arrays = dict(states=self.states, actions=self.actions, rewards=self.rewards, dones=self.dones)
+        if self.share_next_state:
+            arrays['valid'] = self.valid
+        else:
+            arrays['next_states'] = self.next_states
+        return arrays
+
+    def save(self, path):
+        """Snapshot the content of the buffer to a .npz file."""
+        if self.states is None:
+            return
+        tmp = path + '.tmp.npz'
+        np.savez(tmp, pos=self.pos, size=self.size, **self._arrays())
+        os.replace(tmp, path)
+
+    def load(self, path):
+        """Restore a snapshot written by save()."""
+        with np.load(path) as f:
+            if len(f['states']) != self.buffer_size or ('valid' in f) != self.share_next_state:
+                raise ValueError('snapshot ' + path + ' does not match the buffer configuration')
+            self._restore(f)
+        self._bind_tensors()
+
+    def save_memmap(self, directory):
+        """Writes the buffer to one .npy file per array in directory, incrementally: when directory
+        holds the previous save of this buffer only the slots added since are written.
+        The scalars go last, to meta.npz, so an interrupted save still restores the previous one
+        (at worst with a few slots already holding newer transitions)."""
+        if self.states is None:
+            return
+        os.makedirs(directory, exist_ok=True)
+        meta_path = os.path.join(directory, 'meta.npz')
+        incremental = self._saved is not None and self._saved[0] == directory and os.path.exists(meta_path)
+        n_new = self.n_added - self._saved[1] if incremental else None
+        scalars = {}
+        for name, array in self._arrays().items():
+            if array.ndim == 0:
+                scalars[name] = array
+                continue
+            path = os.path.join(directory, name + '.npy')
+            if n_new is None or name not in self._slot_arrays() or not os.path.exists(path):
+                # a new file replacing the old one: the buffer may itself be mapped from it
+                tmp = path + '.tmp.npy'
+                np.save(tmp, array)
+                os.replace(tmp, path)
+            elif n_new > 0:
+                out = np.lib.format.open_memmap(path, mode='r+')
+                # with share_next_state add() also writes the state of the slot at pos
+                slots = (self.pos - np.arange(min(n_new + 1, self.buffer_size))) % self.buffer_size
+                out[slots] = array[slots]
+                out.flush()
+                del out
+        tmp = meta_path + '.tmp.npz'
+        np.savez(tmp, pos=self.pos, size=self.size, n_added=self.n_added, **scalars)
+        os.replace(tmp, meta_path)
+        self._saved = (directory, self.n_added)
+
+    def open_memmap(self, directory):
+        """Restores a save_memmap() snapshot by mapping its files copy-on-write: nothing is read up front,
+        and the transitions added afterwards stay in memory until the next save_memmap.
+        Returns False if directory holds no snapshot."""
+        meta_path = os.path.join(directory, 'meta.npz')
+        if not os.path.exists(meta_path):
+            return False
+        with np.load(meta_path) as meta:
+            f = {name: meta[name] for name in meta.files}
+        for name in os.listdir(directory):
+            if name.endswith('.npy') and not name.endswith('.tmp.npy'):
+                f[name[:-4]] = np.load(os.path.join(directory, name), mmap_mode='c')
+        if len(f['states']) != self.buffer_size or ('valid' in f) != self.share_next_state:
+            raise ValueError('snapshot ' + directory + ' does not match the buffer configuration')
+        self._restore(f)
+        self.n_added = int(f['n_added'])
+        self._saved = (directory, self.n_added)
+        self._bind_tensors()
+        return True
+
+    @staticmethod
+    def _slot_arrays():
+        """Arrays indexed by buffer slot, which save_memmap writes incrementally."""
+        return ('states', 'actions', 'rewards', 'dones', 'valid', 'next_states')
+
+    def _restore(self, f):
+        self.states = f['states']
+        self.actions = f['actions']
+        self.rewards = f['rewards']
+        self.dones = f['dones']
+        if self.share_next_state:
+            self.valid = f['valid']
+        else:
+            self.next_states = f['next_states']
+        self.pos = int(f['pos'])
+        self.size = int(f['size'])
 
-        states = torch.from_numpy(np.stack([e.state for e in experiences if e is not None])).float().to(self.device)
-        actions = torch.from_numpy(np.vstack([e.action for e in experiences if e is not None])).long().to(self.device)
-        rewards = torch.from_numpy(np.vstack([e.reward for e in experiences if e is not None])).float().to(self.device)
-        next_states = torch.from_numpy(np.stack([e.next_state for e in experiences if e is not None])).float().to(
-            self.device)
-        dones = torch.from_numpy(np.vstack([e.done for e in experiences if e is not None]).astype(np.uint8)).float().to(
-            self.device)
+    def sample_indices(self, batch_size=None):
+        """Uniformly sample indices of stored transitions."""
+        batch_size = self.batch_size if batch_size is None else batch_size
+        idx = np.random.randint(0, self.size, size=batch_size)
+        if self.share_next_state:
+            invalid = ~self.valid[idx]
+            while invalid.any():
+                idx[invalid] = np.random.randint(0, self.size, size=int(invalid.sum()))
+                invalid = ~self.valid[idx]
+        return idx
 
-        return (states, actions, rewards, next_states, dones)
+    def get(self, idx):
+        """Gathers the transitions at idx into (states, actions, rewards, next_states, dones) tensors."""
+        idx_t = torch.from_numpy(np.asarray(idx, dtype=np.int64))
+        states = torch.index_select(self._states_t, 0, idx_t)
+        if self.share_next_state:
+            next_states = torch.index_select(self._states_t, 0, (idx_t + 1) % self.buffer_size)
+        else:
+            next_states = torch.index_select(self._next_states_t, 0, idx_t)
+        actions = torch.index_select(self._actions_t, 0, idx_t)
+        rewards = torch.index_select(self._rewards_t, 0, idx_t)
+        dones = torch.index_select(self._dones_t, 0, idx_t)
+        return (states.to(self.device), actions.to(self.device), rewards.to(self.device),
+                next_states.to(self.device), dones.to(self.device))
+
+    def sample(self, n_batches=None):
+        """Randomly sample a batch of experiences from memory.
+        With n_batches, samples a block of n_batches batches at once: every tensor is (n_batches, batch, ...)."""
+        if n_batches is None:
+            return self.get(self.sample_indices())
+        experiences = self.get(self.sample_indices(n_batches * self.batch_size))
+        return tuple(e.view(n_batches, self.batch_size, *e.shape[1:]) for e in experiences)
 
     def __len__(self):
         """Return the current size of internal memory."""
-        return len(self.memory)
+        return self.size
+
+
+class SumTree:
+    """Array-based sum-tree over buffer slots: tree[1] is the total priority and the leaf of
+    slot i is tree[n_leaves + i]. Batched updates and samples walk the tree one level at a time
+    with NumPy, so both cost O(log n) vector operations for the whole batch."""
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.depth = max(1, int(np.ceil(np.log2(capacity))))
+        self.n_leaves = 1 << self.depth
+        self.tree = np.zeros(2 * self.n_leaves, dtype=np.float64)
+
+    @property
+    def total(self):
+        return self.tree[1]
+
+    def leaves(self, idx):
+        return self.tree[self.n_leaves + np.asarray(idx)]
+
+    def set(self, i, priority):
+        """Sets the priority of a single slot."""
+        node = self.n_leaves + int(i)
+        self.tree[node] = priority
+        node >>= 1
+        while node >= 1:
+            self.tree[node] = self.tree[2 * node] + self.tree[2 * node + 1]
+            node >>= 1
+
+    def update(self, idx, priorities):
+        """Sets the priorities of a batch of slots."""
+        nodes = self.n_leaves + np.asarray(idx, dtype=np.int64)
+        self.tree[nodes] = priorities
+        for _ in range(self.depth):
+            nodes >>= 1
+            self.tree[nodes] = self.tree[2 * nodes] + self.tree[2 * nodes + 1]
+
+    def find(self, values):
+        """Returns the slots whose cumulative priority interval contains each value in [0, total)."""
+        values = np.array(values, dtype=np.float64)
+        nodes = np.ones(len(values), dtype=np.int64)
+        for _ in range(self.depth):
+            left = self.tree[2 * nodes]
+            go_right = values >= left
+            values -= left * go_right
+            nodes = 2 * nodes + go_right
+        return nodes - self.n_leaves
+
+
+class PrioritizedReplayBuffer(ReplayBuffer):
+    """ReplayBuffer sampling transitions proportionally to their priority |TD error|^alpha."""
+
+    def __init__(self, buffer_size, batch_size, device, alpha=0.6, beta=0.4, beta_increment=1e-4, eps=1e-6,
+                 share_next_state=False):
+        """Initialize a PrioritizedReplayBuffer object.
+        Params
+        ======
+            alpha (float): how much prioritization is used (0 is uniform sampling)
+            beta (float): initial importance-sampling exponent, annealed to 1
+            beta_increment (float): increment of beta at every sample
+            eps (float): added to the TD errors so no transition gets a zero priority
+        """
+        super(PrioritizedReplayBuffer, self).__init__(buffer_size, batch_size, device, share_next_state)
+        self.tree = SumTree(buffer_size)
+        self.alpha = alpha
+        self.beta = beta
+        self.beta_increment = beta_increment
+        self.eps = eps
+        self.max_priority = 1.0
+
+    def add(self, state, action, reward, next_state, done):
+        """Add a new experience to memory with the maximal priority seen so far."""
+        pos = self.pos
+        super(PrioritizedReplayBuffer, self).add(state, action, reward, next_state, done)
+        self.tree.set(pos, self.max_priority ** self.alpha)
+        if self.share_next_state:
+            for i in ((pos - 1) % self.buffer_size, (pos + 1) % self.buffer_size):
+                if not self.valid[i] and self.tree.leaves(i) > 0:
+                    self.tree.set(i, 0.0)
+
+    def add_batch(self, states, actions, rewards, next_states, dones):
+        """Add a batch of consecutive experiences to memory with the maximal priority seen so far."""
+        if self.share_next_state:
+            return super(PrioritizedReplayBuffer, self).add_batch(states, actions, rewards, next_states, dones)
+        slots = super(PrioritizedReplayBuffer, self).add_batch(states, actions, rewards, next_states, dones)
+        self.tree.update(slots, np.full(len(slots), self.max_priority ** self.alpha))
+        return slots
+
+    def _arrays(self):
+        arrays = super(PrioritizedReplayBuffer, self)._arrays()
+        arrays['tree'] = self.tree.tree
+        arrays['max_priority'] = np.array(self.max_priority)
+        arrays['beta'] = np.array(self.beta)
+        return arrays
+
+    def _restore(self, f):
+        super(PrioritizedReplayBuffer, self)._restore(f)
+        self.tree.tree = f['tree']
+        self.max_priority = float(f['max_priority'])
+        self.beta = float(f['beta'])
+
+    def sample_indices(self, batch_size=None):
+        """Stratified sampling of indices proportionally to their priority."""
+        batch_size = self.batch_size if batch_size is None else batch_size
+        segment = self.tree.total / batch_size
+        idx = self.tree.find((np.arange(batch_size) + np.random.rand(batch_size)) * segment)
+        # guard against float round-off landing on an empty leaf
+        empty = self.tree.leaves(idx) <= 0
+        while empty.any():
+            idx[empty] = self.tree.find(np.random.rand(int(empty.sum())) * self.tree.total)
+            empty = self.tree.leaves(idx) <= 0
+        return idx
+
+    def sample(self, n_batches=None):
+        """Sample a batch of experiences by priority.
+        Returns the experiences, their importance-sampling weights (batch, 1) and their indices.
+        With n_batches, samples a block of n_batches batches: everything gets a leading n_batches dimension."""
+        if n_batches is None:
+            idx = self.sample_indices()
+        else:
+            idx = self.sample_indices(n_batches * self.batch_size)
+        probs = self.tree.leaves(idx) / self.tree.total
+        weights = (self.size * probs) ** (-self.beta)
+        weights /= weights.max()
+        self.beta = min(1.0, self.beta + self.beta_increment)
+        weights = torch.from_numpy(weights.astype(np.float32)).unsqueeze(1).to(self.device)
+        experiences = self.get(idx)
+        if n_batches is None:
+            return experiences, weights, idx
+        shape = (n_batches, self.batch_size)
+        return (tuple(e.view(*shape, *e.shape[1:]) for e in experiences), weights.view(*shape, 1),
+                idx.reshape(shape))
+
+    def update_priorities(self, idx, td_errors):
+        """Sets the priorities of sampled transitions from their absolute TD errors."""
+        priorities = np.abs(np.asarray(td_errors, dtype=np.float64).reshape(-1)) + self.eps
+        self.max_priority = max(self.max_priority, priorities.max())
+        self.tree.update(np.asarray(idx).reshape(-1), priorities ** self.alpha)
+
+
+class StackedReplayBuffer:
+    """Replay buffers of a population of houses stepping together: arrays (n_house, buffer_size, ...)
+    written one row per house by every add, sampled into (n_house, batch, ...) tensors."""
+
+    def __init__(self, n_house, buffer_size, batch_size, device):
+        self.n_house = n_house
+        self.buffer_size = buffer_size
+        self.batch_size = batch_size
+        self.device = device
+        self.pos = 0
+        self.size = 0
+        self.states = None
+        self._houses = np.arange(n_house)[:, None]
+
+    def add(self, states, actions, rewards, next_states, dones):
+        """Add one experience per house, every argument has a leading n_house dimension."""
+        if self.states is None:
+            state_shape = np.shape(states)[1:]
+            self.states = np.zeros((self.n_house, self.buffer_size) + state_shape, dtype=np.float32)
+            self.next_states = np.zeros((self.n_house, self.buffer_size) + state_shape, dtype=np.float32)
+            self.actions = np.zeros((self.n_house, self.buffer_size, 1), dtype=np.int64)
+            self.rewards = np.zeros((self.n_house, self.buffer_size, 1), dtype=np.float32)
+            self.dones = np.zeros((self.n_house, self.buffer_size, 1), dtype=np.float32)
+        self.states[:, self.pos] = states
+        self.next_states[:, self.pos] = next_states
+        self.actions[:, self.pos, 0] = actions
+        self.rewards[:, self.pos, 0] = rewards
+        self.dones[:, self.pos, 0] = dones
+        self.pos = (self.pos + 1) % self.buffer_size
+        self.size = min(self.size + 1, self.buffer_size)
+
+    def sample(self):
+        """Independently for every house, randomly sample a batch of experiences."""
+        idx = np.random.randint(0, self.size, size=(self.n_house, self.batch_size))
+        return tuple(torch.from_numpy(a[self._houses, idx]).to(self.device)
+                     for a in (self.states, self.actions, self.rewards, self.next_states, self.dones))
+
+    def __len__(self):
+        return self.size
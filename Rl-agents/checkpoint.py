@@ -0,0 +1,96 @@
+import os
+import random
+import numpy as np
+import torch
+
+
+def _atomic_save(obj, path):
+    tmp = path + '.tmp'
+    torch.save(obj, tmp)
+    os.replace(tmp, path)
+
+
+def rng_state():
+    state = {'python': random.getstate(), 'numpy': np.random.get_state(), 'torch': torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+class Checkpoint:
+    """Checkpoints of a training run, to resume it after a crash.
+    Every save writes, for each house, the replay buffer as memory-mapped arrays in buffer_<i>/ and
+    house_<i>.pt (DSAC networks, optimizers, temperatures and the state of its environment), then
+    state.pt (episode and RNG states) last. The .pt files are replaced atomically, the networks of
+    all houses together. The buffers are written incrementally and mapped copy-on-write on resume,
+    so neither saving nor resuming copies the whole buffers; after an interrupted save they may
+    hold a few more transitions than the networks have seen.
+    The policies read by evaluation.load_policies are the policy_<i>.pt of evaluation.save_policies."""
+
+    def __init__(self, directory, every=1):
+        """Params
+        ======
+            directory (str): directory of the checkpoint
+            every (int): federation episodes between two saves (save_to_file_every), 0 disables them
+        """
+        self.directory = directory
+        self.every = every
+
+    def house_path(self, house):
+        return os.path.join(self.directory, 'house_' + str(house) + '.pt')
+
+    def buffer_dir(self, house):
+        return os.path.join(self.directory, 'buffer_' + str(house))
+
+    def due(self, episode):
+        return self.every > 0 and (episode + 1) % self.every == 0
+
+    def save(self, episode, multi_agents, extra=None):
+        """Saves the houses (Multi_Agents, in house order) after federation episode `episode`."""
+        os.makedirs(self.directory, exist_ok=True)
+        for house, agent in enumerate(multi_agents):
+            if agent.buffer is not None:
+                agent.buffer.save_memmap(self.buffer_dir(house))
+        # every house is written aside before any is replaced, so a crash leaves a consistent set of networks
+        for house, agent in enumerate(multi_agents):
+            state = agent.agents.state_dict()
+            state['warmed_up'] = agent.warmed_up
+            # plain python values, so the actor stays loadable with torch.load(weights_only=True)
+            state['env'] = {k: v.item() if isinstance(v, np.generic) else v
+                            for k, v in vars(agent.env.unwrapped).items() if k.startswith('currentState_')}
+            torch.save(state, self.house_path(house) + '.tmp')
+        for house in range(len(multi_agents)):
+            os.replace(self.house_path(house) + '.tmp', self.house_path(house))
+        _atomic_save({'episode': episode, 'n_house': len(multi_agents), 'rng': rng_state(), 'extra': extra},
+                     os.path.join(self.directory, 'state.pt'))
+
+    def load(self, multi_agents):
+        """Restores the last save into multi_agents. Returns the first episode still to run
+        and the extra state given to save, or (0, None) if there is no checkpoint."""
+        path = os.path.join(self.directory, 'state.pt')
+        if not os.path.exists(path):
+            return 0, None
+        state = torch.load(path, weights_only=False)
+        if state['n_house'] != len(multi_agents):
+            raise ValueError('checkpoint ' + self.directory + ' has ' + str(state['n_house']) + ' houses')
+        # the position of a streamed source in its files is not saved: it would restart at the first chunk
+        if any(getattr(agent.env.unwrapped, 'source', None) is not None for agent in multi_agents):
+            raise ValueError('resume does not support envTrain_files, the environments would not continue '
+                             'from the rows of the checkpoint')
+        for house, agent in enumerate(multi_agents):
+            house_state = torch.load(self.house_path(house), map_location=agent.agents.device, weights_only=False)
+            agent.agents.load_state_dict(house_state)
+            vars(agent.env.unwrapped).update(house_state['env'])
+            if agent.buffer is not None and agent.buffer.open_memmap(self.buffer_dir(house)):
+                agent.warmed_up = house_state['warmed_up']
+        set_rng_state(state['rng'])
+        print("Resumed from", self.directory, "after episode", state['episode'])
+        return state['episode'] + 1, state['extra']
@@ -0,0 +1,248 @@
+import hashlib
+import os
+import queue
+import threading
+import numpy as np
+
+# Columns of the cached dataset
+HOUR = 0
+PRICE = 1  # in euros per kWh
+CONSUMPTION = 2  # in kW
+PRODUCTION = 3  # in kW
+N_COLUMNS = 4
+
+_opened = {}
+# column maxima of the opened datasets, see dataset_maxima
+_maxima = {}
+
+
+def file_hash(path, chunk_size=1 << 20):
+    """sha1 of the content of a file."""
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def cache_path(path):
+    """Location of the binary cache of a csv file, keyed by the hash of its content."""
+    directory, name = os.path.split(os.path.abspath(path))
+    stem = os.path.splitext(name)[0]
+    return os.path.join(directory, '.cache', stem + '-' + file_hash(path)[:16] + '.npy')
+
+
+def _csv_frames(path, chunk_rows):
+    """pandas DataFrames of chunk_rows rows of a house csv."""
+    # pandas is only needed the first time a csv is seen, keep it off the startup path
+    import pandas
+    with open(path, 'r', encoding='utf-8', errors='replace') as f:
+        header = f.readline()
+    sep = ';' if header.count(';') > header.count(',') else ','
+    return pandas.read_csv(path, sep=sep, header=0, chunksize=chunk_rows)
+
+
+def _convert(df):
+    """(n, 4) float64 array of (hour, price, consumption, production) of a DataFrame of the csv."""
+    import pandas
+    hour = pandas.to_datetime(df['Date and time (UTC)']).dt.hour.values
+    data = np.column_stack((hour, df.iloc[:, [3, 4, 5]].values)).astype(np.float64)
+    data[:, PRICE] /= 100  # in euros per kWh
+    data[:, CONSUMPTION] /= 1000  # in kW
+    return data
+
+
+def _count_rows(path):
+    with open(path, 'rb') as f:
+        lines = sum(chunk.count(b'\n') for chunk in iter(lambda: f.read(1 << 20), b''))
+        f.seek(-1, os.SEEK_END)
+        # a last line without newline, minus the header
+        return lines + (f.read(1) != b'\n') - 1
+
+
+def write_cache(path, out, chunk_rows=1 << 16):
+    """Converts a csv into the columnar (4, N) .npy file out, chunk_rows rows at a time,
+    so the memory used does not grow with the size of the csv."""
+    n = _count_rows(path)
+    columns = np.lib.format.open_memmap(out, mode='w+', dtype=np.float64, shape=(N_COLUMNS, n))
+    first = 0
+    for df in _csv_frames(path, chunk_rows):
+        data = _convert(df)
+        columns[:, first:first + len(data)] = data.T
+        first += len(data)
+    if first != n:
+        raise ValueError('read ' + str(first) + ' rows of ' + path + ', expected ' + str(n))
+    columns.flush()
+    del columns
+
+
+def load_dataset(path):
+    """Returns the columnar (4, N) dataset of a csv as a read-only memory map.
+    The csv is parsed only the first time: the columns are written to a .npy cache
+    next to the csv, and every later call (from this or another process) maps that file.
+    """
+    key = os.path.abspath(path)
+    stat = os.stat(key)
+    opened = _opened.get(key)
+    if opened is not None and opened[0] == (stat.st_size, stat.st_mtime):
+        return opened[1]
+
+    cache = cache_path(key)
+    if not os.path.exists(cache):
+        os.makedirs(os.path.dirname(cache), exist_ok=True)
+        tmp = cache + '.' + str(os.getpid()) + '.tmp'
+        write_cache(key, tmp)
+        os.replace(tmp, cache)
+    # a plain ndarray view of the map: arithmetic on np.memmap slices pays for the subclass on every operation
+    columns = np.load(cache, mmap_mode='r').view(np.ndarray)
+    _opened[key] = ((stat.st_size, stat.st_mtime), columns)
+    return columns
+
+
+def dataset_maxima(path, n_agents=1, chunk_rows=1 << 16):
+    """(n_agents, 4) maxima of the absolute values of the columns over the rows iloc[i::n_agents] of
+    every house i. Computed chunk by chunk the first time, then kept next to the memory map, so
+    the houses of a process share one pass over the file."""
+    key = os.path.abspath(path)
+    columns = load_dataset(key)
+    cached = _maxima.get((key, n_agents))
+    if cached is not None and cached[0] is columns:
+        return cached[1]
+    N = columns.shape[1]
+    maxima = np.zeros((n_agents, N_COLUMNS))
+    # whole rounds of n_agents rows, then the last incomplete round
+    T = N // n_agents * n_agents
+    step = chunk_rows * n_agents
+    for first in range(0, T, step):
+        block = np.abs(columns[:, first:min(first + step, T)]).reshape(N_COLUMNS, -1, n_agents)
+        maxima = np.maximum(maxima, block.max(1).T)
+    tail = np.abs(columns[:, T:]).T
+    maxima[:len(tail)] = np.maximum(maxima[:len(tail)], tail)
+    _maxima[(key, n_agents)] = (columns, maxima)
+    return maxima
+
+
+def house_view(path, agent_id, n_agents):
+    """(T, 4) view of the rows iloc[agent_id::n_agents] of a dataset, without copying."""
+    return load_dataset(path)[:, agent_id::n_agents].T
+
+
+def houses_view(path, n_agents):
+    """(n_agents, T, 4) view of the dataset where house i holds the rows iloc[i::n_agents].
+    The dataset is truncated to a multiple of n_agents rows so all houses have the same length.
+    """
+    columns = load_dataset(path)
+    T = columns.shape[1] // n_agents
+    return columns[:, :T * n_agents].reshape(N_COLUMNS, T, n_agents).transpose(2, 1, 0)
+
+
+def prefetch(iterable, depth=2):
+    """Iterates over iterable while a background thread computes the next depth items.
+    Closing the returned generator (or dropping it) stops the thread."""
+    items = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+    done = object()
+
+    def produce():
+        try:
+            for item in iterable:
+                while not stop.is_set():
+                    try:
+                        items.put(item, timeout=0.1)
+                        break
+                    except queue.Full:
+                        pass
+                if stop.is_set():
+                    return
+            items.put(done)
+        except BaseException as e:
+            items.put(e)
+
+    thread = threading.Thread(target=produce, name='dataset-prefetch', daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = items.get()
+            if item is done:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        stop.set()
+
+
+class StreamingSource:
+    """Bounded-memory access to the rows of one house (rows iloc[agent_id::n_agents]), or of all houses
+    with agent_id None, across several dataset files. cycle() streams the rows in order and windows()
+    draws random episode windows from any of the files, both read from the memory-mapped caches by a
+    background thread that stays `prefetch` chunks or windows ahead. Only those few copies are held in
+    memory, whatever the size and number of the files. Like houses_view, every file is truncated to a
+    multiple of n_agents rows so all houses have the same length."""
+
+    def __init__(self, paths, agent_id=0, n_agents=1, chunk_rows=4096, prefetch=2, seed=None):
+        """Params
+        ======
+            paths (list): csv files, in order
+            agent_id (int): the house, or None for all houses as (n_agents, rows, 4) arrays
+            n_agents (int): the number of houses sharing the files
+            chunk_rows (int): rows of the house per chunk
+            prefetch (int): chunks or windows read ahead
+            seed (int): seed of the window sampling
+        """
+        self.paths = list(paths)
+        self.files = [load_dataset(path) for path in self.paths]
+        self.agent_id = agent_id
+        self.n_agents = n_agents
+        self.chunk_rows = chunk_rows
+        self.prefetch = prefetch
+        self.rng = np.random.RandomState(seed)
+        self.lengths = np.array([columns.shape[1] // n_agents for columns in self.files])
+
+    def __len__(self):
+        return int(self.lengths.sum())
+
+    def rows(self, f, start, stop):
+        """Copy of the rows start..stop of the house in file f: (stop - start, 4), or
+        (n_agents, stop - start, 4) for all houses."""
+        n = self.n_agents
+        if self.agent_id is None:
+            columns = self.files[f][:, start * n:stop * n]
+            return np.ascontiguousarray(columns.reshape(N_COLUMNS, stop - start, n).transpose(2, 1, 0))
+        return np.ascontiguousarray(self.files[f][:, self.agent_id + start * n:self.agent_id + stop * n:n].T)
+
+    def _cycle(self):
+        last = None
+        while True:
+            for f, length in enumerate(self.lengths):
+                for start in range(0, length, self.chunk_rows):
+                    chunk = self.rows(f, start, min(start + self.chunk_rows, length))
+                    yield chunk if last is None else np.concatenate((last, chunk), axis=-2)
+                    last = chunk[..., -1:, :]
+
+    def cycle(self):
+        """Endless chunks of <= chunk_rows rows, file after file and over again. After the first one,
+        every chunk starts with the last row of the previous chunk, so the hour of the previous row
+        stays at hand when an environment moves to the next chunk."""
+        return prefetch(self._cycle(), self.prefetch)
+
+    def _windows(self, length):
+        # every start position of every file is equally likely
+        n_starts = np.maximum(self.lengths - length + 1, 0)
+        if not n_starts.sum():
+            raise ValueError('no file holds a window of ' + str(length) + ' rows')
+        p = n_starts / n_starts.sum()
+        while True:
+            f = self.rng.choice(len(self.files), p=p)
+            start = self.rng.randint(n_starts[f])
+            yield self.rows(f, start, start + length)
+
+    def windows(self, length):
+        """Endless windows of length consecutive rows, starting anywhere in any file."""
+        return prefetch(self._windows(length), self.prefetch)
+
+    def maxima(self):
+        """Maximum of |hour|, |price|, |consumption| and |production| over the rows of the house
+        (of all houses with agent_id None) in every file."""
+        maxima = np.array([dataset_maxima(path, self.n_agents) for path in self.paths]).max(0)
+        return maxima.max(0) if self.agent_id is None else maxima[self.agent_id]
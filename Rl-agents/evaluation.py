@@ -0,0 +1,100 @@
+import os
+import numpy as np
+import torch
+
+from dataset import PRICE, CONSUMPTION, PRODUCTION
+from house import VecProgressusEnv, house_step
+from networks import StackedActor
+
+
+def policy_path(directory, house):
+    return os.path.join(directory, 'policy_' + str(house) + '.pt')
+
+
+def save_policies(directory, actors):
+    """Writes the actor state_dict of every house to directory/policy_<i>.pt, next to (not over) the
+    house_<i>.pt of a checkpoint.Checkpoint."""
+    os.makedirs(directory, exist_ok=True)
+    for house, actor in enumerate(actors):
+        tmp = policy_path(directory, house) + '.tmp'
+        torch.save({'actor': actor.state_dict()}, tmp)
+        os.replace(tmp, policy_path(directory, house))
+
+
+def load_policies(directory, n_house, state_size, action_size):
+    """Stacks the actors saved in directory into one StackedActor."""
+    actor = None
+    for house in range(n_house):
+        state_dict = torch.load(policy_path(directory, house), map_location='cpu')['actor']
+        if actor is None:
+            actor = StackedActor(n_house, state_size, action_size, state_dict['fc1.weight'].shape[0])
+        with torch.no_grad():
+            for k in range(3):
+                getattr(actor, 'weight' + str(k))[house].copy_(state_dict['fc' + str(k + 1) + '.weight'])
+                getattr(actor, 'bias' + str(k))[house, 0].copy_(state_dict['fc' + str(k + 1) + '.bias'])
+    return actor
+
+
+def greedy_rollout(actor, env, start_row=0, horizon=None, window=512):
+    """Greedy rollout of every house over the data of env, vectorized over houses.
+    The battery level is the only sequential part of the state: the first layer of the actor is
+    applied to the (production, consumption, hour) features of a whole window of time steps in
+    one batched matmul, and only the battery term and the last two layers run step by step.
+    Returns per-step rewards, CO2 (kg), battery levels and actions, each of shape (n_house, horizon)."""
+    n_house, T = env.data.shape[0], env.data.shape[1]
+    horizon = T - start_row if horizon is None else horizon
+    rewards = np.zeros((n_house, horizon))
+    co2 = np.zeros((n_house, horizon))
+    batteries = np.zeros((n_house, horizon))
+    actions = np.zeros((n_house, horizon), dtype=np.int64)
+    battery = np.zeros(n_house)
+
+    w1, b1 = actor.weight0.transpose(1, 2), actor.bias0  # (n_house, obs_dim, hidden), (n_house, 1, hidden)
+    with torch.no_grad():
+        for first in range(0, horizon, window):
+            rows = (start_row + np.arange(first, min(first + window, horizon))) % T
+            # observation at row t: (battery, production[t], consumption[t], hour[t - 1])
+            features = np.stack((env.data[:, rows, PRODUCTION], env.data[:, rows, CONSUMPTION],
+                                 env.data_time[:, rows - 1]), axis=-1)
+            pre = torch.baddbmm(b1, torch.from_numpy(features.astype(np.float32)), w1[:, 1:])
+            for k, row in enumerate(rows):
+                t = first + k
+                x = torch.relu(pre[:, k] + torch.from_numpy(battery.astype(np.float32)).unsqueeze(1) * w1[:, 0])
+                x = torch.relu(torch.baddbmm(actor.bias1, x.unsqueeze(1), actor.weight1.transpose(1, 2)))
+                logits = torch.baddbmm(actor.bias2, x, actor.weight2.transpose(1, 2)).squeeze(1)
+                action = logits.argmax(-1).numpy()
+                reward, battery, co2_kg = house_step(action, battery, env.data[:, row, PRICE],
+                                                     env.data[:, row, CONSUMPTION], env.data[:, row, PRODUCTION],
+                                                     env.sell_price[:, row], env.batteryCapacity)
+                rewards[:, t], co2[:, t], batteries[:, t], actions[:, t] = reward, co2_kg, battery, action
+    return rewards, co2, batteries, actions
+
+
+def summarize(rewards, co2, batteries, actions, n_actions=5):
+    """Per-house reward, CO2 (dic_diffpro) and battery summaries of a rollout."""
+    return dict(total_reward=rewards.sum(1), mean_reward=rewards.mean(1), total_co2=co2.sum(1),
+                mean_battery=batteries.mean(1), final_battery=batteries[:, -1],
+                action_freq=np.stack([(actions == a).mean(1) for a in range(n_actions)], axis=1))
+
+
+def evaluate(config, configfile, checkpoint_dir, output=None):
+    """code_model = Inference: greedy rollout of the trained policies of every house over envTest."""
+    n_house = int(config.get('Simulation', 'n_house'))
+    env = VecProgressusEnv(global_seed=int(config.get('Simulation', 'global_seed')), configfile=configfile,
+                           n_agents=n_house, dataset='envTest')
+    actor = load_policies(checkpoint_dir, n_house, env.observation_space.shape[0], env.action_space.n)
+    summary = summarize(*greedy_rollout(actor, env))
+    if config.getboolean('DRL', 'oracle', fallback=False):
+        # optimal schedule over the same rows, for the gap of the policies
+        from oracle import solve_env
+        summary['oracle_reward'] = solve_env(env, n_levels=int(config.get('DRL', 'oracle_levels', fallback=201)))['value']
+    print("house  total_reward  mean_reward  total_co2_kg  mean_battery" +
+          ("  oracle_reward" if 'oracle_reward' in summary else ""))
+    for h in range(n_house):
+        print("{:5d}  {:12.4f}  {:11.6f}  {:12.3f}  {:12.4f}".format(
+            h, summary['total_reward'][h], summary['mean_reward'][h], summary['total_co2'][h],
+            summary['mean_battery'][h]) +
+              ("  {:13.4f}".format(summary['oracle_reward'][h]) if 'oracle_reward' in summary else ""))
+    if output:
+        np.savez(output, **summary)
+    return summary
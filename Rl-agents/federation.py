@@ -0,0 +1,270 @@
+import math
+import time
+import numpy as np
+import torch
+
+
+def agent_parameters(agent):
+    """Parameters of a DSAC agent exchanged by the federation, in a fixed order:
+    actor, critics, target critics."""
+    params = []
+    for module in (agent.actor_local, agent.critic, agent.critic_target):
+        params.extend(p.data for p in module.parameters())
+    return params
+
+
+def parameters_to_vector(params, out=None):
+    """Flattens params into one contiguous vector (written into out if given)."""
+    return torch.cat([p.reshape(-1) for p in params], out=out)
+
+
+def vector_to_parameters_(vector, params):
+    """Writes a flat vector back into params in place, so views and optimizers stay bound to them."""
+    chunks = torch.split(vector, [p.numel() for p in params])
+    chunks = [c.view_as(p) for c, p in zip(chunks, params)]
+    if hasattr(torch, '_foreach_copy_'):
+        torch._foreach_copy_(params, chunks)
+    else:
+        for p, c in zip(params, chunks):
+            p.copy_(c)
+
+
+class UpdateCodec:
+    """Compression of the update a house sends to the federation: the delta from the last global
+    model, int8-quantized per block of values ('int8') or reduced to its top-k entries ('topk').
+    With error feedback the part of the delta lost by the compression is kept and added to the
+    next delta, so the compression error does not accumulate in the global model."""
+
+    def __init__(self, n_params, method='int8', topk_ratio=0.01, block_size=4096, error_feedback=True):
+        """Params
+        ======
+            n_params (int): size of the flat parameter vector
+            method (str): 'int8' or 'topk'
+            topk_ratio (float): fraction of the entries sent by 'topk'
+            block_size (int): number of values sharing one float32 scale in 'int8'
+            error_feedback (bool): carry the compression error over to the next update
+        """
+        if method not in ('int8', 'topk'):
+            raise ValueError('unknown compression ' + str(method))
+        self.n_params = n_params
+        self.method = method
+        self.k = max(1, int(math.ceil(topk_ratio * n_params)))
+        self.block_size = block_size
+        self.n_blocks = int(math.ceil(n_params / block_size))
+        self.error_feedback = error_feedback
+        self.residual = torch.zeros(n_params)
+
+    def encode(self, local_vector, global_vector):
+        """Compresses local_vector - global_vector (plus the residual). Returns the payload."""
+        delta = local_vector - global_vector
+        if self.error_feedback:
+            delta += self.residual
+        if self.method == 'int8':
+            blocks = torch.zeros(self.n_blocks * self.block_size)
+            blocks[:self.n_params] = delta
+            blocks = blocks.view(self.n_blocks, self.block_size)
+            scales = (blocks.abs().max(1)[0] / 127).clamp(min=1e-12)
+            q = torch.round(blocks / scales.unsqueeze(1)).clamp(-127, 127).to(torch.int8)
+            payload = ('int8', q, scales)
+        else:
+            idx = torch.topk(delta.abs(), self.k, sorted=False)[1]
+            payload = ('topk', idx.to(torch.int32), delta[idx])
+        if self.error_feedback:
+            self.residual = delta - self.decode(payload)
+        return payload
+
+    def decode(self, payload):
+        """Dense delta of a payload."""
+        method, a, b = payload
+        if method == 'int8':
+            return (a.to(torch.float32) * b.unsqueeze(1)).view(-1)[:self.n_params]
+        delta = torch.zeros(self.n_params)
+        delta[a.long()] = b
+        return delta
+
+    @staticmethod
+    def nbytes(payload):
+        _, a, b = payload
+        return a.numel() * a.element_size() + b.numel() * b.element_size()
+
+
+class FederatedAverage:
+    """FDRL_Strategy = Average: weighted average of the networks of all houses.
+    The parameters of the houses are gathered into the rows of a preallocated
+    (chunk_size, n_params) matrix, averaged with one matrix-vector product per chunk of
+    houses and written back in place into every house."""
+
+    def __init__(self, agents, chunk_size=256, compression='none', topk_ratio=0.01, matrix=None):
+        """Params
+        ======
+            agents (list): DSAC agents of the federation
+            chunk_size (int): houses gathered per matrix-vector product, bounds the memory
+            compression (str): 'none', or the UpdateCodec method compressing the house updates
+            topk_ratio (float): fraction of the entries sent with 'topk' compression
+            matrix (torch.Tensor): (rows, n_params) buffer to gather the houses into, shared between
+                aggregators; allocated if None
+        """
+        self.agents = agents
+        self.params = [agent_parameters(agent) for agent in agents]
+        self.sizes = [p.numel() for p in self.params[0]]
+        self.n_params = sum(self.sizes)
+        device = self.params[0][0].device
+        if matrix is None:
+            matrix = torch.empty(min(chunk_size, len(agents)), self.n_params, device=device)
+        self.matrix = matrix
+        self.global_vector = torch.zeros(self.n_params, device=device)
+        self.codecs = None
+        if compression != 'none':
+            self.codecs = [UpdateCodec(self.n_params, compression, topk_ratio) for _ in agents]
+            # all houses start from the same model, which is the first global model
+            parameters_to_vector(self.params[0], out=self.global_vector)
+            self.scatter(self.global_vector)
+        # uplink bytes and aggregation time of the last round
+        self.stats = {}
+
+    def state_dict(self):
+        """State carried from one round to the next: the global model the compressed deltas are taken
+        from and the error-feedback residual of every house."""
+        return {'global_vector': self.global_vector.clone(),
+                'residuals': None if self.codecs is None else [codec.residual.clone() for codec in self.codecs]}
+
+    def load_state_dict(self, state):
+        """Restores a state_dict(), e.g. when resuming from a checkpoint."""
+        self.global_vector.copy_(state['global_vector'])
+        if self.codecs is not None:
+            for codec, residual in zip(self.codecs, state['residuals']):
+                codec.residual = residual.clone()
+
+    def scatter(self, vector, houses=None):
+        """Writes vector into the parameters of houses (all of them if None), in place."""
+        houses = range(len(self.params)) if houses is None else houses
+        chunks = [c.view_as(p) for c, p in zip(torch.split(vector, self.sizes), self.params[0])]
+        targets = [p for h in houses for p in self.params[h]]
+        with torch.no_grad():
+            if hasattr(torch, '_foreach_copy_'):
+                torch._foreach_copy_(targets, chunks * (len(targets) // len(chunks)))
+            else:
+                for p, c in zip(targets, chunks * (len(targets) // len(chunks))):
+                    p.copy_(c)
+
+    def aggregate(self, weights=None):
+        """Averages the houses with weights (uniform if None) and writes the result back into every house.
+        Returns the flat global parameter vector."""
+        n_house = len(self.agents)
+        if weights is None:
+            weights = np.ones(n_house)
+        weights = torch.as_tensor(np.asarray(weights, dtype=np.float32), device=self.matrix.device)
+        weights = weights / weights.sum()
+        start = time.time()
+        if self.codecs is not None:
+            return self._aggregate_compressed(weights, start)
+        chunk_size = self.matrix.shape[0]
+        with torch.no_grad():
+            self.global_vector.zero_()
+            for first in range(0, n_house, chunk_size):
+                last = min(first + chunk_size, n_house)
+                for h in range(first, last):
+                    parameters_to_vector(self.params[h], out=self.matrix[h - first])
+                self.global_vector.addmv_(self.matrix[:last - first].t(), weights[first:last])
+        self.scatter(self.global_vector)
+        dense = n_house * self.n_params * 4
+        self.stats = dict(bytes=dense, dense_bytes=dense, seconds=time.time() - start)
+        return self.global_vector
+
+    def _aggregate_compressed(self, weights, start):
+        """Every house sends its compressed delta from the global model, the global model moves by
+        the weighted average of the decoded deltas."""
+        n_bytes = 0
+        local = self.matrix[0]
+        update = torch.zeros_like(self.global_vector)
+        with torch.no_grad():
+            for h, codec in enumerate(self.codecs):
+                parameters_to_vector(self.params[h], out=local)
+                payload = codec.encode(local, self.global_vector)
+                n_bytes += codec.nbytes(payload)
+                update.add_(codec.decode(payload), alpha=float(weights[h]))
+            self.global_vector.add_(update)
+        self.scatter(self.global_vector)
+        self.stats = dict(bytes=n_bytes, dense_bytes=len(self.codecs) * self.n_params * 4,
+                          seconds=time.time() - start)
+        return self.global_vector
+
+
+def house_locations(config, n_house):
+    """Location (feeder) of every house: the comma separated [Simulation] house_locations, or
+    n_locations contiguous groups of houses if it is not given."""
+    locations = config.get('Simulation', 'house_locations', fallback='').strip()
+    if locations:
+        locations = [l.strip() for l in locations.split(',')]
+        if len(locations) != n_house:
+            raise ValueError('house_locations must give one location per house')
+        return locations
+    n_locations = int(config.get('Simulation', 'n_locations', fallback=1))
+    groups = np.array_split(np.arange(n_house), n_locations)
+    return ['location' + str(g) for g, houses in enumerate(groups) for _ in houses]
+
+
+class HierarchicalAverage:
+    """Two-tier federation: the houses of every location are averaged by an edge aggregator every
+    round, and the edge models are averaged into a global model every global_every rounds.
+    Each edge only sees its own houses and the global tier only sees one model per edge, so the
+    fan-in of every aggregation stays bounded as houses are added."""
+
+    def __init__(self, agents, locations, global_every=5, chunk_size=256, compression='none', topk_ratio=0.01):
+        """Params
+        ======
+            agents (list): DSAC agents of the federation
+            locations (list): location of every agent
+            global_every (int): rounds between two global aggregations
+        """
+        self.global_every = global_every
+        self.rounds = 0
+        self.edges = {}
+        for location in sorted(set(locations)):
+            self.edges[location] = [h for h, l in enumerate(locations) if l == location]
+        n_params = sum(p.numel() for p in agent_parameters(agents[0]))
+        # one gathering buffer shared by every edge
+        matrix = torch.empty(min(chunk_size, max(len(h) for h in self.edges.values())), n_params)
+        self.aggregators = {location: FederatedAverage([agents[h] for h in houses], chunk_size, compression,
+                                                       topk_ratio, matrix=matrix)
+                            for location, houses in self.edges.items()}
+        self.edge_matrix = torch.empty(len(self.edges), n_params)
+        self.stats = {}
+
+    def state_dict(self):
+        """Round counter and the state of every edge aggregator."""
+        return {'rounds': self.rounds,
+                'edges': {location: aggregator.state_dict() for location, aggregator in self.aggregators.items()}}
+
+    def load_state_dict(self, state):
+        self.rounds = state['rounds']
+        for location, aggregator in self.aggregators.items():
+            aggregator.load_state_dict(state['edges'][location])
+
+    def aggregate(self, weights=None):
+        """Runs the edge tier, and the global tier every global_every rounds. Returns the global vector
+        of the last global aggregation, or None on edge-only rounds."""
+        start = time.time()
+        n_house = sum(len(houses) for houses in self.edges.values())
+        weights = np.ones(n_house) if weights is None else np.asarray(weights, dtype=np.float64)
+        edge_weights = []
+        edge_bytes = 0
+        for e, (location, houses) in enumerate(self.edges.items()):
+            aggregator = self.aggregators[location]
+            self.edge_matrix[e] = aggregator.aggregate(weights[houses])
+            edge_bytes += aggregator.stats['bytes']
+            edge_weights.append(weights[houses].sum())
+        self.rounds += 1
+        global_vector = None
+        global_bytes = 0
+        if self.rounds % self.global_every == 0:
+            w = torch.as_tensor(np.asarray(edge_weights, dtype=np.float32))
+            with torch.no_grad():
+                global_vector = torch.mv(self.edge_matrix.t(), w / w.sum())
+            for aggregator in self.aggregators.values():
+                aggregator.global_vector.copy_(global_vector)
+                aggregator.scatter(global_vector)
+            global_bytes = self.edge_matrix.numel() * 4
+        self.stats = dict(bytes=edge_bytes + global_bytes, edge_bytes=edge_bytes, global_bytes=global_bytes,
+                          dense_bytes=n_house * self.edge_matrix.shape[1] * 4, seconds=time.time() - start)
+        return global_vector
@@ -8,17 +8,9 @@ import configparser
 
 import numpy as np
 
-import tensorflow as tf
-
-import tensorflow_probability as tfp
-
 import math
 
-import pandas
-
-from scipy.stats import poisson
-
-import pickle
+from dataset import house_view, houses_view, dataset_maxima, StreamingSource, HOUR, PRICE, CONSUMPTION, PRODUCTION
 
 
 def registration(max_episode):
@@ -54,33 +46,30 @@ class ProgressusEnv(gym.Env):
         self.config = configparser.RawConfigParser(defaults=None, strict=False)
         self.config.read(configfile)
   
-        # load data (csv)
-        df = pandas.read_csv(self.config.get('Simulation', 'envTrain'), sep=",", header=0)
-        df['Date and time (UTC)'] = pandas.to_datetime(df['Date and time (UTC)'])
-        df['hour'] = df['Date and time (UTC)'].dt.hour
-        data = df.iloc[self.agent_id::self.n_agents]
-        self.data = data.values
-        self.data_time = data['hour'].values
+        # envTrain_files: several data files streamed chunk by chunk instead of the memory-mapped envTrain
+        self.episode_windows = self.config.getboolean('Simulation', 'episode_windows', fallback=False)
+        self.source, self._rows = stream_rows(self.config, self.agent_id or 0, self.n_agents or 1,
+                                              None if global_seed is None else global_seed + (self.agent_id or 0))
+        if self.source is not None:
+            maxima = self.source.maxima()
+            self.data = next(self._rows)
+        else:
+            # load data: strided view of the memory-mapped dataset shared by all houses
+            self.data = house_view(self.config.get('Simulation', 'envTrain'), self.agent_id, self.n_agents)
+            maxima = dataset_maxima(self.config.get('Simulation', 'envTrain'), self.n_agents or 1)[self.agent_id or 0]
+        self.data_time = self.data[:, HOUR]
         # 29.66 per 100 kilowatt-hour
         # 0.0002966 per watt-hour
-        self.sell_price = (.3 * (1 - np.exp(-((self.data_time - 14) ** 2) / 5))) * 1e-3
-        if self.agent_id == 0:
-            with open('Time.pkl', 'ab') as f:
-                pickle.dump(self.data_time, f)
-            with open('price.pkl', 'ab') as f:
-                pickle.dump(self.sell_price, f)
-        self.panelProdMax = max(self.data[:, 5]) 
-        self.consumptionMax = max(self.data[:, 4])
-        self.priceMax = max(abs(self.data[:, 3]))
+        self.sell_price = sell_price(self.data_time)
+        # the dataset is already in kW and euros per kWh, the maxima are kept in the csv units
+        self.panelProdMax = maxima[PRODUCTION]
+        self.consumptionMax = maxima[CONSUMPTION] * 1000
+        self.priceMax = maxima[PRICE] * 100
         # print("max price", self.priceMax)
-        self.data[:, 5] /= 1 # in kW. production
-        self.data[:, 4] /= 1000  # in kW. consumption
-        # self.data[:, 3] /= self.priceMax
-        self.data[:, 3] /= 100  # in euros per kWh
         self.currentState_row = 0
-        self.currentState_price = self.data[self.currentState_row, 3] # in euros per kWh
-        self.currentState_consumption = self.data[self.currentState_row, 4] # in kw
-        self.currentState_panelProd = self.data[self.currentState_row, 5]# in kw
+        self.currentState_price = self.data[self.currentState_row, PRICE] # in euros per kWh
+        self.currentState_consumption = self.data[self.currentState_row, CONSUMPTION] # in kw
+        self.currentState_panelProd = self.data[self.currentState_row, PRODUCTION]# in kw
         self.currentState_battery = 0.0
         self.diffProd = 0
         # Capacity of the battery
@@ -160,11 +149,13 @@ class ProgressusEnv(gym.Env):
         self.currentState_battery = np.clip(current_battery_temp, 0, self.batteryCapacity)
 
         self.currentState_row += 1
+        if self.currentState_row >= len(self.data):
+            self._next_rows()
         row = self.currentState_row
 
-        self.currentState_price = self.data[row, 3]
-        self.currentState_consumption = self.data[row, 4]
-        self.currentState_panelProd = self.data[row, 5]
+        self.currentState_price = self.data[row, PRICE]
+        self.currentState_consumption = self.data[row, CONSUMPTION]
+        self.currentState_panelProd = self.data[row, PRODUCTION]
 
         state1 = self.currentState_battery
         state2 = self.currentState_panelProd
@@ -178,7 +169,26 @@ class ProgressusEnv(gym.Env):
         return np.array(self.state, dtype=np.float32), reward, False, dict(dic_diffpro=co2_kg,
                                                                                   dic_battery=self.currentState_battery)
 
+    def _next_rows(self):
+        """Moves past the last row of self.data: to the next chunk of a streamed source (a new window
+        with episode_windows), or back to the first row of the dataset, so the rows never run out."""
+        if self.source is None:
+            self.currentState_row = 0
+            return
+        self.data = next(self._rows)
+        self.currentState_row = 0 if self.episode_windows else 1
+        self.data_time = self.data[:, HOUR]
+        self.sell_price = sell_price(self.data_time)
+
     def reset(self):
+        if self.source is not None and self.episode_windows:
+            self.data = next(self._rows)
+            self.data_time = self.data[:, HOUR]
+            self.sell_price = sell_price(self.data_time)
+            self.currentState_row = 0
+            self.currentState_price = self.data[0, PRICE]
+            self.currentState_consumption = self.data[0, CONSUMPTION]
+            self.currentState_panelProd = self.data[0, PRODUCTION]
 
         self.state = [self.currentState_battery, self.currentState_panelProd, self.currentState_consumption,
                       self.data_time[self.currentState_row - 1]]
@@ -187,3 +197,149 @@ class ProgressusEnv(gym.Env):
 
 
 
+def relu(x):
+    return np.maximum(0, x)
+
+
+def stream_rows(config, agent_id, n_agents, seed=None):
+    """StreamingSource of the [Simulation] envTrain_files of a house (of all houses with agent_id None),
+    and the endless iterator of the rows an environment steps through: a random window of
+    Max_Episode + 1 rows per episode with episode_windows, the chunks of all the rows otherwise
+    (see StreamingSource.cycle). (None, None) if envTrain_files is not set."""
+    files = config.get('Simulation', 'envTrain_files', fallback='').strip()
+    if not files:
+        return None, None
+    source = StreamingSource([f.strip() for f in files.split(',')], agent_id, n_agents,
+                             chunk_rows=int(config.get('Simulation', 'chunk_rows', fallback=4096)), seed=seed)
+    if config.getboolean('Simulation', 'episode_windows', fallback=False):
+        return source, source.windows(int(config.get('DRL', 'Max_Episode')) + 1)
+    return source, source.cycle()
+
+
+def sell_price(hours):
+    """Selling price (euros per kWh) at the given hours of the day, highest around 14h."""
+    return (.3 * (1 - np.exp(-((hours - 14) ** 2) / 5))) * 1e-3
+
+
+def house_step(action, battery, price, consumption, production, sell_price, battery_capacity):
+    """Charge/sell/discharge/buy arithmetic of ProgressusEnv.step on NumPy arrays.
+    Every argument broadcasts, so the same code steps one house or a whole batch.
+    Params
+    ======
+        action (int or np.ndarray): action(s) in {0: charge, 1: charge_sell, 2: discharge, 3: sell, 4: buy}
+        battery (float or np.ndarray): battery level before the action (kWh)
+        price, consumption, production (float or np.ndarray): market price, consumption and production of the row
+        sell_price (float or np.ndarray): selling price of the row
+        battery_capacity (float): capacity of the battery (kWh)
+    Returns
+    ======
+        reward, clipped battery level and kg of CO2 of the step
+    """
+    diffProd = production - consumption
+    current_battery_temp = battery + (action - 3) * (action - 4) * diffProd
+    reward_charge = -relu(current_battery_temp - battery_capacity) * (action - 1) * (action - 2) * (
+                action - 3) * (action - 4)
+    reward_charge_sell = relu(current_battery_temp - battery_capacity) * sell_price * (
+                             action) * (action - 2) * (action - 3) * (action - 4)
+    reward_discharge = -10 * relu(-(current_battery_temp - .1 * battery_capacity)) * (action) * (action - 1) * (
+                action - 3) * (
+                               action - 4)
+    reward_sell = sell_price * relu(diffProd) * (action) * (action - 1) * (
+                action - 2) * (action - 4)
+    reward_buy = -price * relu(-diffProd) * (action) * (action - 1) * (action - 2) * (
+                action - 3)
+    reward = reward_charge + reward_charge_sell + reward_discharge + reward_sell + reward_buy
+    battery = np.clip(current_battery_temp, 0, battery_capacity)
+    co2_kg = relu(-diffProd) * 0.3855535
+    return reward, battery, co2_kg
+
+
+class VecProgressusEnv:
+    """Batched ProgressusEnv stepping every house with one NumPy call.
+    The data of all houses is held as one (n_agents, T, 4) array whose features are
+    (hour, price, consumption, production); house i gets the rows iloc[i::n_agents],
+    exactly as ProgressusEnv does for agent_id = i.
+    """
+
+    def __init__(self, global_seed=None, configfile=None, n_agents=None, max_episode_steps=None, dataset='envTrain'):
+        """dataset is the [Simulation] key of the data file: envTrain, or envTest for evaluation."""
+        self.global_seed = global_seed
+        self.n_agents = n_agents
+        self.max_episode_steps = max_episode_steps
+        self.action_space = spaces.Discrete(5)
+        self.config = configparser.RawConfigParser(defaults=None, strict=False)
+        self.config.read(configfile)
+
+        # the training data may be streamed from envTrain_files, as in ProgressusEnv
+        self.episode_windows = self.config.getboolean('Simulation', 'episode_windows', fallback=False)
+        self.source, self._rows = (None, None) if dataset != 'envTrain' else \
+            stream_rows(self.config, None, self.n_agents, global_seed)
+        if self.source is not None:
+            maxima = self.source.maxima()
+            self.data = next(self._rows)
+        else:
+            # load data: (n_agents, T, 4) view of the memory-mapped dataset
+            self.data = houses_view(self.config.get('Simulation', dataset), self.n_agents)
+            maxima = dataset_maxima(self.config.get('Simulation', dataset), self.n_agents).max(0)
+
+        self.data_time = self.data[:, :, HOUR]
+        self.sell_price = sell_price(self.data_time)
+        self.panelProdMax = maxima[PRODUCTION]
+        self.consumptionMax = maxima[CONSUMPTION] * 1000
+        self.priceMax = maxima[PRICE] * 100
+
+        self.batteryCapacity = 2  # kWh
+        self.currentState_row = 0
+        self.currentState_battery = np.zeros(self.n_agents)
+        self.elapsed_steps = 0
+
+        high = np.array((self.batteryCapacity, self.panelProdMax, self.consumptionMax / 1000, 24), dtype=np.float32)
+        low = np.array((0, 0, 0, 0), dtype=np.float32)
+        # observation/action spaces of a single house, as seen by the agents
+        self.observation_space = spaces.Box(low, high, dtype=np.float32)
+
+    def sample_actions(self):
+        """Returns one uniformly random action per house."""
+        return np.random.randint(self.action_space.n, size=self.n_agents)
+
+    def _observation(self):
+        row = self.currentState_row % self.data.shape[1]
+        return np.stack((self.currentState_battery,
+                         self.data[:, row, PRODUCTION],
+                         self.data[:, row, CONSUMPTION],
+                         self.data_time[:, row - 1]), axis=1).astype(np.float32)
+
+    def step(self, actions):
+        """Steps all houses with an action vector of shape (n_agents,).
+        Returns stacked observations (n_agents, 4), rewards (n_agents,), dones (n_agents,)
+        and an info dict of (n_agents,) arrays.
+        """
+        actions = np.asarray(actions).reshape(self.n_agents)
+        row = self.currentState_row % self.data.shape[1]
+        price = self.data[:, row, PRICE]
+        consumption = self.data[:, row, CONSUMPTION]
+        production = self.data[:, row, PRODUCTION]
+        reward, self.currentState_battery, co2_kg = house_step(actions, self.currentState_battery, price,
+                                                               consumption, production, self.sell_price[:, row],
+                                                               self.batteryCapacity)
+        self.currentState_row += 1
+        if self.source is not None and self.currentState_row >= self.data.shape[1]:
+            self._next_rows()
+        self.elapsed_steps += 1
+        done = self.max_episode_steps is not None and self.elapsed_steps >= self.max_episode_steps
+        dones = np.full(self.n_agents, done)
+        return self._observation(), reward, dones, dict(dic_diffpro=co2_kg,
+                                                        dic_battery=self.currentState_battery.copy())
+
+    def _next_rows(self):
+        """Moves to the next chunk (a new window with episode_windows) of the streamed source."""
+        self.data = next(self._rows)
+        self.currentState_row = 0 if self.episode_windows else 1
+        self.data_time = self.data[:, :, HOUR]
+        self.sell_price = sell_price(self.data_time)
+
+    def reset(self):
+        self.elapsed_steps = 0
+        if self.source is not None and self.episode_windows:
+            self._next_rows()
+        return self._observation()
@@ -7,12 +7,19 @@ import numpy as np
 import random
 import gym
 from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
-from house import registration
-#from Agent import DDPG, DQN, DDQN
-from Agent import DQN, DDQN, A2C, DSAC, DDPG, Random_Battery, Random
+from house import registration, VecProgressusEnv
+from Agent import DSAC, load_agent_class
 from MultiAgent import Multi_Agent
+from utils import collect_random_vec
+from federation import FederatedAverage, HierarchicalAverage, house_locations
+from parallel import ParallelTrainer, AsyncFederation
+from population import run_population
+from evaluation import evaluate, save_policies
+from checkpoint import Checkpoint
+from metrics import MetricsSink
+from profiling import profile_summary, write_trace
+from offline import generate, run_offline
 import time
-import pylab
 import pickle
 
 
@@ -56,14 +63,83 @@ def main():
     battery_list_fed = []
     # Instantiation of Gym environments for every House
    
-    if config.get('DRL', '_class_ML') == 'DSAC':
-        drl_class = DSAC
-        drl_class_NAME = 'DSAC'
+    drl_class_NAME = config.get('DRL', '_class_ML').strip()
+    drl_class = load_agent_class(drl_class_NAME)
  
 
 
 
 
+    checkpoint_dir = config.get('DRL', 'checkpoint_dir', fallback='trained_models/' + config_name)
+    metrics_dir = config.get('DRL', 'metrics_dir', fallback='metrics/' + config_name)
+    resume = config.getboolean('DRL', 'resume', fallback=False)
+    if config.get('DRL', 'code_model').strip() == 'Inference':
+        evaluate(config, args.config, checkpoint_dir, output=os.path.join(checkpoint_dir, 'evaluation.npz'))
+        print_simulation_time(start)
+        return
+
+    # Offline dataset generation, and offline training on it
+    offline_dir = config.get('DRL', 'offline_dir', fallback='Data/offline')
+    if config.get('DRL', 'code_model').strip() == 'Generate':
+        generate(config, args.config, offline_dir, int(config.get('DRL', 'offline_steps', fallback=100000)),
+                 behaviour=config.get('DRL', 'offline_behaviour', fallback='random').strip(),
+                 epsilon=float(config.get('DRL', 'offline_epsilon', fallback=0.0)),
+                 shard_size=int(config.get('DRL', 'offline_shard_size', fallback=1 << 16)),
+                 checkpoint_dir=checkpoint_dir)
+        print_simulation_time(start)
+        return
+    training_mode = config.get('DRL', 'training_mode', fallback='houses').strip()
+    n_workers = int(config.get('Simulation', 'n_workers', fallback=0))
+    if drl_class_NAME == 'DSAC' and training_mode == 'offline':
+        check_mode_options(config, 'training_mode = offline')
+        agents = run_offline(config, args.config)
+        save_policies(checkpoint_dir, [agent.actor_local for agent in agents])
+        print_simulation_time(start)
+        return
+
+    # Population training: all houses as one stacked-parameter model on a vectorized environment
+    if drl_class_NAME == 'DSAC' and training_mode == 'population':
+        check_mode_options(config, 'training_mode = population')
+        metrics = MetricsSink(metrics_dir)
+        model = run_population(config, args.config, metrics)
+        metrics.close()
+        save_policies(checkpoint_dir, model.actor_modules())
+        print_simulation_time(start)
+        return
+
+    # Parallel training: one worker process per group of houses, weights exchanged through shared memory
+    if n_workers > 0 and drl_class_NAME == 'DSAC':
+        check_mode_options(config, 'n_workers > 0')
+    if n_workers > 0 and drl_class_NAME == 'DSAC' and config.get('DRL', 'FDRL_Strategy').strip() == 'Async':
+        federation = AsyncFederation(args.config, n_house, n_workers,
+                                     alpha=float(config.get('DRL', 'async_alpha', fallback=0.6)),
+                                     exponent=float(config.get('DRL', 'staleness_exponent', fallback=0.5)))
+        federation.run(n_fed_episodes)
+        save_policies(checkpoint_dir, federation.actors())
+        print_simulation_time(start)
+        return
+    if n_workers > 0 and drl_class_NAME == 'DSAC':
+        trainer = ParallelTrainer(args.config, n_house, n_workers)
+        save_every = int(config.get('DRL', 'save_to_file_every', fallback=0))
+        for j in range(n_fed_episodes):
+            print("Episode = ", j, "/", n_fed_episodes)
+            # the workers have no MetricsSink: report the round from the stats they return
+            stats = trainer.round(federate=federation_mode)
+            scores = np.array([stats[i][1] for i in range(n_house)])
+            print("mean score {:.4f} (house min {:.4f} / max {:.4f}), {} transitions per house".format(
+                scores.mean(), scores.min(), scores.max(), stats[0][0]))
+            # no resume in worker processes: the policies are saved, not the full houses
+            if save_every > 0 and (j + 1) % save_every == 0:
+                save_policies(checkpoint_dir, trainer.actors())
+        save_policies(checkpoint_dir, trainer.actors())
+        trainer.close()
+        print_simulation_time(start)
+        return
+
+    # the sequential loop only federates with Average, Async runs in worker processes
+    if federation_mode and drl_class_NAME == 'DSAC' and config.get('DRL', 'FDRL_Strategy').strip() == 'Async':
+        raise ValueError('FDRL_Strategy = Async needs n_workers > 0')
+
     for i in range(n_house):
         key = 'env' + str(i + 1)
         if key not in ENV_dic.keys():
@@ -75,19 +151,115 @@ def main():
                                     )
             AGENTS_dic[key] = Multi_Agent(drl_class, ENV_dic[key], config, config_name, i)
 
+    # Replay buffers: restore the snapshots of a previous run, then warm up the others all at once
+    buffer_dir = config.get('DRL', 'buffer_dir', fallback=None)
+    if drl_class_NAME == 'DSAC':
+        if buffer_dir:
+            for agent in AGENTS_dic.values():
+                agent.load_buffer(buffer_dir)
+        agents = [AGENTS_dic['env' + str(i + 1)] for i in range(n_house)]
+        if not all(agent.warmed_up for agent in agents):
+            vec_env = VecProgressusEnv(global_seed=global_seed, configfile=args.config, n_agents=n_house,
+                                       max_episode_steps=n_decisions_per_episode)
+            collect_random_vec(vec_env, [None if agent.warmed_up else agent.buffer for agent in agents],
+                               num_samples=agents[0].n_warmup)
+            for agent in agents:
+                agent.warmed_up = True
+
+    fdrl_strategy = config.get('DRL', 'FDRL_Strategy', fallback='Average').strip()
+    aggregator = None
+    if federation_mode and drl_class_NAME == 'DSAC' and fdrl_strategy == 'Average':
+        houses = [AGENTS_dic['env' + str(i + 1)].agents for i in range(n_house)]
+        compression = config.get('DRL', 'FDRL_Compression', fallback='none').strip()
+        topk_ratio = float(config.get('DRL', 'topk_ratio', fallback=0.01))
+        if config.get('DRL', 'FDRL_Topology', fallback='flat').strip() == 'hierarchical':
+            aggregator = HierarchicalAverage(houses, house_locations(config, n_house),
+                                             global_every=int(config.get('DRL', 'global_every', fallback=5)),
+                                             compression=compression, topk_ratio=topk_ratio)
+        else:
+            aggregator = FederatedAverage(houses, compression=compression, topk_ratio=topk_ratio)
+
+    # Checkpoints every save_to_file_every episodes, and resume from the last one
+    checkpoint = None
+    first_episode = 0
+    if drl_class_NAME == 'DSAC':
+        checkpoint = Checkpoint(checkpoint_dir, every=int(config.get('DRL', 'save_to_file_every', fallback=0)))
+        if resume:
+            first_episode, extra = checkpoint.load([AGENTS_dic['env' + str(i + 1)] for i in range(n_house)])
+            # the aggregator was built from the fresh houses: give it back the global model and residuals
+            if extra and extra.get('aggregator') is not None and aggregator is not None:
+                aggregator.load_state_dict(extra['aggregator'])
+
+    metrics = MetricsSink(metrics_dir, append=resume)
+    for agent in AGENTS_dic.values():
+        agent.metrics = metrics
+
     # Train the Agents for n_episodes
-    for j in range(int(config.get('DRL', 'n_episodes'))):
+    for j in range(first_episode, int(config.get('DRL', 'n_episodes'))):
         # save the model
 
         print("Episode = ",j,"/", config.get('DRL', 'n_episodes'))
+        metrics.episode = j
 
-        # Multiprocessing
-#        with ProcessPoolExecutor(10) as executor:
         for i in range(n_house):
-            #p_process[i] = executor.submit(AGENTS_dic[('env' + str(i + 1))].run())
             AGENTS_dic[('env' + str(i + 1))].run()
             
+        # Federation round: houses are weighted by the experience they have collected
+        if aggregator is not None:
+            aggregator.aggregate([len(AGENTS_dic['env' + str(i + 1)].buffer) for i in range(n_house)])
+            print("Federation: {:.3f} MB uploaded ({:.1f}x less than dense), aggregated in {:.1f} ms".format(
+                aggregator.stats['bytes'] / 1e6, aggregator.stats['dense_bytes'] / aggregator.stats['bytes'],
+                aggregator.stats['seconds'] * 1e3))
+
+        if checkpoint is not None and checkpoint.due(j):
+            checkpoint.save(j, [AGENTS_dic['env' + str(i + 1)] for i in range(n_house)],
+                            extra={'aggregator': None if aggregator is None else aggregator.state_dict()})
+            save_policies(checkpoint_dir, [AGENTS_dic['env' + str(i + 1)].agents.actor_local for i in range(n_house)])
+
+    if drl_class_NAME == 'DSAC' and buffer_dir:
+        for agent in AGENTS_dic.values():
+            agent.save_buffer(buffer_dir)
+    if checkpoint is not None and not checkpoint.due(int(config.get('DRL', 'n_episodes')) - 1):
+        checkpoint.save(int(config.get('DRL', 'n_episodes')) - 1, [AGENTS_dic['env' + str(i + 1)] for i in range(n_house)],
+                        extra={'aggregator': None if aggregator is None else aggregator.state_dict()})
+        save_policies(checkpoint_dir, [AGENTS_dic['env' + str(i + 1)].agents.actor_local for i in range(n_house)])
+
+    if config.getboolean('DRL', 'profile', fallback=False):
+        profilers = [AGENTS_dic['env' + str(i + 1)].profiler for i in range(n_house)]
+        print(profile_summary(profilers))
+        trace_path = config.get('DRL', 'profile_trace', fallback='').strip()
+        if trace_path:
+            write_trace(trace_path, profilers)
+
+    metrics.close()
+    summary = metrics.summary()
+    print("Mean reward per step {:.5f}, mean CO2 per step {:.4f} kg over {} steps".format(
+        summary['reward']['mean'], summary['diffpro']['mean'], summary['reward']['count']))
+
+    print_simulation_time(start)
+
+
+def check_mode_options(config, mode):
+    """Resume, replay buffer snapshots, profiling and the federation topology and compression are
+    options of the sequential houses mode: raises a ValueError naming those set for another mode."""
+    unsupported = []
+    if config.getboolean('DRL', 'resume', fallback=False):
+        unsupported.append('resume = True')
+    if config.get('DRL', 'buffer_dir', fallback='').strip():
+        unsupported.append('buffer_dir')
+    if config.getboolean('DRL', 'profile', fallback=False):
+        unsupported.append('profile = True')
+    if config.get('DRL', 'FDRL_Topology', fallback='flat').strip() != 'flat':
+        unsupported.append('FDRL_Topology = ' + config.get('DRL', 'FDRL_Topology').strip())
+    if config.get('DRL', 'FDRL_Compression', fallback='none').strip() != 'none':
+        unsupported.append('FDRL_Compression = ' + config.get('DRL', 'FDRL_Compression').strip())
+    if mode.startswith('training_mode') and int(config.get('Simulation', 'n_workers', fallback=0)) > 0:
+        unsupported.append('n_workers > 0')
+    if unsupported:
+        raise ValueError(mode + ' does not support ' + ', '.join(unsupported))
+
 
+def print_simulation_time(start):
     end = time.time()
     simulation_time = end-start
 
@@ -0,0 +1,160 @@
+import json
+import os
+import threading
+import time
+import numpy as np
+
+STEP_COLUMNS = [('episode', np.int32), ('house', np.int32), ('step', np.int32), ('action', np.int8),
+                ('reward', np.float32), ('diffpro', np.float32), ('battery', np.float32)]
+EPISODE_COLUMNS = [('episode', np.int32), ('house', np.int32), ('steps', np.int32), ('score', np.float64),
+                   ('mean_reward', np.float64), ('mean_diffpro', np.float64), ('mean_battery', np.float64)]
+
+
+class ColumnRing:
+    """Fixed-size ring of rows stored column by column. One thread appends, another drains;
+    head and tail count the rows ever appended and drained."""
+
+    def __init__(self, columns, capacity):
+        self.names = [name for name, _ in columns]
+        self.arrays = [np.zeros(capacity, dtype=dtype) for _, dtype in columns]
+        self.capacity = capacity
+        self.head = 0
+        self.tail = 0
+
+    def free(self):
+        return self.capacity - (self.head - self.tail)
+
+    def append(self, row):
+        i = self.head % self.capacity
+        for array, value in zip(self.arrays, row):
+            array[i] = value
+        self.head += 1
+
+    def extend(self, columns):
+        """Appends n rows given as one sequence (or scalar) per column, n <= capacity."""
+        n = max(np.size(c) for c in columns)
+        slots = (self.head + np.arange(n)) % self.capacity
+        for array, values in zip(self.arrays, columns):
+            array[slots] = values
+        self.head += n
+
+    def drain(self):
+        """Copies out the rows appended since the last drain, one array per column."""
+        head = self.head
+        slots = np.arange(self.tail, head) % self.capacity
+        rows = [array[slots] for array in self.arrays]
+        self.tail = head
+        return rows
+
+
+class MetricsSink:
+    """Per-step and per-episode training metrics. The training loop only writes rows into
+    preallocated ring buffers; a background thread drains them every flush_interval seconds (or
+    when a ring is half full) and appends every column to its own raw file <table>/<column>.bin,
+    keeping running aggregates (count, sum, min, max) of the numeric step columns.
+    read_metrics() loads a table back as NumPy arrays."""
+
+    def __init__(self, directory, capacity=1 << 16, flush_interval=5.0, append=False):
+        """Params
+        ======
+            directory (str): directory of the metric files
+            capacity (int): rows of each ring buffer
+            flush_interval (float): seconds between two flushes
+            append (bool): append to the files of a previous run (resume) instead of truncating them
+        """
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.episode = 0
+        self.rings = {'steps': ColumnRing(STEP_COLUMNS, capacity), 'episodes': ColumnRing(EPISODE_COLUMNS, capacity)}
+        self.files = {}
+        for table, columns in (('steps', STEP_COLUMNS), ('episodes', EPISODE_COLUMNS)):
+            os.makedirs(os.path.join(directory, table), exist_ok=True)
+            with open(os.path.join(directory, table, 'schema.json'), 'w') as f:
+                json.dump([(name, np.dtype(dtype).str) for name, dtype in columns], f)
+            self.files[table] = [open(os.path.join(directory, table, name + '.bin'), 'ab' if append else 'wb')
+                                 for name, _ in columns]
+        self.aggregates = {name: dict(count=0, sum=0.0, min=np.inf, max=-np.inf)
+                           for name in ('reward', 'diffpro', 'battery')}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name='metrics-flush', daemon=True)
+        self._thread.start()
+
+    def _reserve(self, ring, n=1):
+        if ring.free() < n:
+            # the flusher is behind: wake it and wait for room rather than overwrite unwritten rows
+            self._wake.set()
+            while ring.free() < n:
+                time.sleep(1e-4)
+        elif ring.free() - n < ring.capacity // 2 <= ring.free():
+            self._wake.set()
+
+    def log_step(self, house, step, action, reward, diffpro, battery):
+        """Records one environment step of a house. O(1), no I/O."""
+        ring = self.rings['steps']
+        self._reserve(ring)
+        ring.append((self.episode, house, step, action, reward, diffpro, battery))
+
+    def log_steps(self, houses, step, actions, rewards, diffpro, battery):
+        """Records one step of several houses at once (vectorized environments)."""
+        ring = self.rings['steps']
+        self._reserve(ring, len(houses))
+        ring.extend((self.episode, houses, step, actions, rewards, diffpro, battery))
+
+    def log_episode(self, house, steps, score, diffpro_sum, battery_sum):
+        """Records the summary of an episode of a house, from the running sums of its steps."""
+        ring = self.rings['episodes']
+        self._reserve(ring)
+        n = max(steps, 1)
+        ring.append((self.episode, house, steps, score, score / n, diffpro_sum / n, battery_sum / n))
+
+    def _run(self):
+        while not self._closed:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self._flush()
+
+    def _flush(self):
+        with self._lock:
+            for table, ring in self.rings.items():
+                rows = ring.drain()
+                if not len(rows[0]):
+                    continue
+                for f, column in zip(self.files[table], rows):
+                    f.write(column.tobytes())
+                    f.flush()
+                if table == 'steps':
+                    for name, column in zip(ring.names, rows):
+                        if name in self.aggregates:
+                            agg = self.aggregates[name]
+                            agg['count'] += len(column)
+                            agg['sum'] += float(column.sum(dtype=np.float64))
+                            agg['min'] = min(agg['min'], float(column.min()))
+                            agg['max'] = max(agg['max'], float(column.max()))
+
+    def summary(self):
+        """Running aggregates of the step metrics, up to date with everything logged so far."""
+        self._flush()
+        return {name: dict(agg, mean=agg['sum'] / agg['count'] if agg['count'] else float('nan'))
+                for name, agg in self.aggregates.items()}
+
+    def close(self):
+        """Stops the flush thread, writes the remaining rows and closes the files."""
+        if self._closed:
+            return
+        self._closed = True
+        self._wake.set()
+        self._thread.join()
+        self._flush()
+        for files in self.files.values():
+            for f in files:
+                f.close()
+
+
+def read_metrics(directory, table='steps'):
+    """Loads a table written by MetricsSink as {column: np.ndarray}."""
+    with open(os.path.join(directory, table, 'schema.json')) as f:
+        schema = json.load(f)
+    return {name: np.fromfile(os.path.join(directory, table, name + '.bin'), dtype=np.dtype(dtype))
+            for name, dtype in schema}
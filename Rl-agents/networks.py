@@ -5,6 +5,20 @@ import numpy as np
 import torch.nn.functional as F
 
 
+def soft_update(local_model, target_model, tau):
+    """Soft update of the parameters of target_model towards local_model.
+    θ_target = τ*θ_local + (1 - τ)*θ_target
+    """
+    target_params = [p.data for p in target_model.parameters()]
+    local_params = [p.data for p in local_model.parameters()]
+    # one fused in-place lerp over all parameters, no temporaries
+    if hasattr(torch, '_foreach_lerp_'):
+        torch._foreach_lerp_(target_params, local_params, tau)
+    else:
+        for target_param, local_param in zip(target_params, local_params):
+            target_param.lerp_(local_param, tau)
+
+
 def hidden_init(layer):
     fan_in = layer.weight.data.size()[0]
     lim = 1. / np.sqrt(fan_in)
@@ -101,6 +115,105 @@ class Critic(nn.Module):
         return self.fc3(x)
 
 
+class EnsembleCritic(nn.Module):
+    """Ensemble of Critic models whose weights are stacked along a leading member dimension,
+    so the Q-values of every member come from one batched matmul per layer."""
+
+    def __init__(self, state_size, action_size, hidden_size=32, n_members=2):
+        """Initialize parameters and build model.
+        Params
+        ======
+            state_size (int): Dimension of each state
+            action_size (int): Dimension of each action
+            hidden_size (int): Number of nodes in the network layers
+            n_members (int): Number of critics in the ensemble
+        """
+        super(EnsembleCritic, self).__init__()
+        self.n_members = n_members
+        sizes = [(state_size, hidden_size), (hidden_size, hidden_size), (hidden_size, action_size)]
+        self.weights = nn.ParameterList([nn.Parameter(torch.empty(n_members, i, o)) for i, o in sizes])
+        self.biases = nn.ParameterList([nn.Parameter(torch.empty(n_members, 1, o)) for i, o in sizes])
+        self.reset_parameters()
+
+    def reset_parameters(self):
+        # same initialization as Critic, member by member
+        for w, b in zip(self.weights, self.biases):
+            fan_in, fan_out = w.shape[1], w.shape[2]
+            lim = 1. / np.sqrt(fan_out)
+            w.data.uniform_(-lim, lim)
+            b.data.uniform_(-1. / np.sqrt(fan_in), 1. / np.sqrt(fan_in))
+        self.weights[-1].data.uniform_(-3e-3, 3e-3)
+
+    def forward(self, state):
+        """Maps states (batch, state_size), or (n_members, batch, state_size) with one batch per member,
+        -> Q-values of every member (n_members, batch, action_size)."""
+        x = state if state.dim() == 3 else state.unsqueeze(0).expand(self.n_members, *state.shape)
+        x = F.relu(torch.baddbmm(self.biases[0], x, self.weights[0]))
+        x = F.relu(torch.baddbmm(self.biases[1], x, self.weights[1]))
+        return torch.baddbmm(self.biases[2], x, self.weights[2])
+
+    def clip_grad_norm_(self, max_norm):
+        """Clips the gradient norm of every member separately, as clip_grad_norm_ on each Critic would."""
+        grads = [p.grad for p in self.parameters() if p.grad is not None]
+        norms = torch.stack([g.pow(2).flatten(1).sum(1) for g in grads]).sum(0).sqrt()
+        scale = (max_norm / (norms + 1e-6)).clamp(max=1.0)
+        for g in grads:
+            g.mul_(scale.view(-1, *([1] * (g.dim() - 1))))
+
+
+class StackedActor(nn.Module):
+    """Actor models of many houses stacked along a leading house dimension, so the action
+    probabilities of every house come from one batched matmul per layer. This is the batched
+    action API: get_actions returns the actions of all houses for a (n_house, obs_dim) array in
+    one forward, whether the weights are trained in place (population.PopulationDSAC), copied
+    from the Actor of every house (gather) or loaded from their saved policies
+    (evaluation.load_policies)."""
+
+    def __init__(self, n_members, state_size, action_size, hidden_size=32):
+        super(StackedActor, self).__init__()
+        self.n_members = n_members
+        sizes = [(state_size, hidden_size), (hidden_size, hidden_size), (hidden_size, action_size)]
+        for k, (i, o) in enumerate(sizes):
+            # nn.Linear layout: weight (out, in), bias (out,)
+            setattr(self, 'weight' + str(k), nn.Parameter(torch.empty(n_members, o, i)))
+            setattr(self, 'bias' + str(k), nn.Parameter(torch.empty(n_members, 1, o)))
+        self.softmax = nn.Softmax(dim=-1)
+        self.reset_parameters()
+
+    def reset_parameters(self):
+        # same initialization as the nn.Linear layers of Actor, member by member
+        for k in range(3):
+            weight, bias = getattr(self, 'weight' + str(k)), getattr(self, 'bias' + str(k))
+            bound = 1. / np.sqrt(weight.shape[2])
+            weight.data.uniform_(-bound, bound)
+            bias.data.uniform_(-bound, bound)
+
+    def gather(self, actors):
+        """Copies the current weights of the Actor of every house into the stacked tensors.
+        The actors keep their own parameters, later updates need another gather."""
+        with torch.no_grad():
+            for k in range(3):
+                layers = [getattr(actor, 'fc' + str(k + 1)) for actor in actors]
+                getattr(self, 'weight' + str(k)).copy_(torch.stack([layer.weight for layer in layers]))
+                getattr(self, 'bias' + str(k)).copy_(torch.stack([layer.bias for layer in layers]).unsqueeze(1))
+
+    def forward(self, states):
+        """Maps states (n_members, state_size) -> action probabilities (n_members, action_size),
+        or states (n_members, batch, state_size) -> (n_members, batch, action_size)."""
+        x = states.unsqueeze(1) if states.dim() == 2 else states
+        x = F.relu(torch.baddbmm(self.bias0, x, self.weight0.transpose(1, 2)))
+        x = F.relu(torch.baddbmm(self.bias1, x, self.weight1.transpose(1, 2)))
+        probs = self.softmax(torch.baddbmm(self.bias2, x, self.weight2.transpose(1, 2)))
+        return probs.squeeze(1) if states.dim() == 2 else probs
+
+    def get_actions(self, states):
+        """Samples one action per member for states of shape (n_members, state_size), a NumPy array."""
+        states = torch.from_numpy(np.asarray(states, dtype=np.float32)).to(self.weight0.device)
+        with torch.no_grad():
+            actions = Categorical(self(states)).sample()
+        return actions.cpu().numpy()
+
+
 class DDQN_Net(nn.Module):
     def __init__(self, state_size, action_size, layer_size):
         super(DDQN_Net, self).__init__()
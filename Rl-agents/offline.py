@@ -0,0 +1,232 @@
+import json
+import os
+import numpy as np
+import torch
+
+FIELDS = (('states', np.float32), ('actions', np.int8), ('rewards', np.float32), ('next_states', np.float32),
+          ('dones', np.uint8))
+
+
+def house_dir(directory, house):
+    return os.path.join(directory, 'house_' + str(house))
+
+
+class ShardWriter:
+    """Appends the transitions of one house to fixed-size shards of memory-mapped .npy files,
+    <directory>/shard_<k>/<field>.npy. manifest.json lists the finished shards and their number of
+    transitions; it is rewritten atomically after every shard, so readers only see complete shards."""
+
+    def __init__(self, directory, obs_dim, shard_size=1 << 16):
+        self.directory = directory
+        self.obs_dim = obs_dim
+        self.shard_size = shard_size
+        self.shards = []
+        self.arrays = None
+        self.count = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def _open_shard(self):
+        path = os.path.join(self.directory, 'shard_' + str(len(self.shards)))
+        os.makedirs(path, exist_ok=True)
+        self.arrays = {}
+        for name, dtype in FIELDS:
+            shape = (self.shard_size, self.obs_dim) if name.endswith('states') else (self.shard_size,)
+            self.arrays[name] = np.lib.format.open_memmap(os.path.join(path, name + '.npy'), mode='w+',
+                                                          dtype=dtype, shape=shape)
+        self.count = 0
+
+    def _close_shard(self):
+        for array in self.arrays.values():
+            array.flush()
+        self.shards.append({'name': 'shard_' + str(len(self.shards)), 'count': self.count})
+        self.arrays = None
+        tmp = os.path.join(self.directory, 'manifest.json.tmp')
+        with open(tmp, 'w') as f:
+            json.dump({'obs_dim': self.obs_dim, 'shards': self.shards}, f)
+        os.replace(tmp, os.path.join(self.directory, 'manifest.json'))
+
+    def append(self, **columns):
+        """Appends n transitions given as (n, ...) arrays states, actions, rewards, next_states, dones."""
+        n = len(columns['actions'])
+        first = 0
+        while first < n:
+            if self.arrays is None:
+                self._open_shard()
+            k = min(n - first, self.shard_size - self.count)
+            for name, _ in FIELDS:
+                self.arrays[name][self.count:self.count + k] = columns[name][first:first + k]
+            self.count += k
+            first += k
+            if self.count == self.shard_size:
+                self._close_shard()
+
+    def close(self):
+        if self.arrays is not None and self.count > 0:
+            self._close_shard()
+
+
+class ShardedDataset:
+    """Uniform minibatches from the shards of a ShardWriter, read through read-only memory maps:
+    a batch only touches the pages of the rows it samples, the dataset is never loaded in RAM.
+    sample() returns the same tensors as ReplayBuffer.sample."""
+
+    def __init__(self, directory, batch_size, device):
+        with open(os.path.join(directory, 'manifest.json')) as f:
+            manifest = json.load(f)
+        self.batch_size = batch_size
+        self.device = device
+        self.shards = [{name: np.load(os.path.join(directory, shard['name'], name + '.npy'), mmap_mode='r')
+                        for name, _ in FIELDS} for shard in manifest['shards']]
+        # global index of the first transition after every shard
+        self.ends = np.cumsum([shard['count'] for shard in manifest['shards']])
+        self.size = int(self.ends[-1]) if len(self.ends) else 0
+
+    def get(self, idx):
+        """Gathers the transitions at the global indices idx into (states, actions, rewards, next_states, dones)."""
+        idx = np.asarray(idx, dtype=np.int64)
+        shard_of = np.searchsorted(self.ends, idx, side='right')
+        out = {name: np.empty((len(idx),) + self.shards[0][name].shape[1:], dtype=self.shards[0][name].dtype)
+               for name, _ in FIELDS}
+        for s in np.unique(shard_of):
+            rows = np.nonzero(shard_of == s)[0]
+            local = idx[rows] - (self.ends[s - 1] if s > 0 else 0)
+            # sorted reads walk each memory map forward
+            order = np.argsort(local)
+            rows, local = rows[order], local[order]
+            for name, _ in FIELDS:
+                out[name][rows] = self.shards[s][name][local]
+        return (torch.from_numpy(out['states']).to(self.device),
+                torch.from_numpy(out['actions'].astype(np.int64)).unsqueeze(1).to(self.device),
+                torch.from_numpy(out['rewards']).unsqueeze(1).to(self.device),
+                torch.from_numpy(out['next_states']).to(self.device),
+                torch.from_numpy(out['dones'].astype(np.float32)).unsqueeze(1).to(self.device))
+
+    def sample(self, n_batches=None):
+        """Randomly sample a batch, or with n_batches a (n_batches, batch, ...) block, of transitions."""
+        n = self.batch_size * (1 if n_batches is None else n_batches)
+        experiences = self.get(np.random.randint(0, self.size, size=n))
+        if n_batches is None:
+            return experiences
+        return tuple(e.view(n_batches, self.batch_size, *e.shape[1:]) for e in experiences)
+
+    def __len__(self):
+        return self.size
+
+
+class Behaviour:
+    """Behaviour policy of the offline dataset generator, acting for all houses at once.
+    random: uniform actions; oracle: the optimal schedule of every episode (oracle.solve);
+    policy: actions sampled from the trained policies of checkpoint_dir. With probability
+    epsilon a house takes a uniform action instead."""
+
+    def __init__(self, name, env, epsilon=0.0, checkpoint_dir=None):
+        if name not in ('random', 'oracle', 'policy'):
+            raise ValueError('unknown offline_behaviour ' + repr(name))
+        self.name = name
+        self.env = env
+        self.epsilon = epsilon
+        self.schedule = None
+        if name == 'oracle' and env.source is not None and not env.episode_windows:
+            # the schedule of an episode needs all its rows, a streamed chunk may end within the episode
+            raise ValueError('offline_behaviour = oracle needs envTrain, or envTrain_files with episode_windows')
+        if name == 'policy':
+            if checkpoint_dir is None:
+                raise ValueError('offline_behaviour = policy needs the checkpoint_dir of the trained policies')
+            from evaluation import load_policies
+            self.actor = load_policies(checkpoint_dir, env.n_agents, env.observation_space.shape[0],
+                                       env.action_space.n)
+
+    def begin_episode(self, n_steps):
+        if self.name == 'oracle':
+            from oracle import solve_env
+            self.schedule = solve_env(self.env, start_row=self.env.currentState_row % self.env.data.shape[1],
+                                      horizon=n_steps, initial_battery=self.env.currentState_battery)['actions']
+
+    def act(self, t, states):
+        if self.name == 'oracle':
+            actions = self.schedule[:, t].copy()
+        elif self.name == 'policy':
+            actions = self.actor.get_actions(states)
+        else:
+            actions = self.env.sample_actions()
+        if self.epsilon > 0:
+            explore = np.random.rand(len(actions)) < self.epsilon
+            actions[explore] = self.env.sample_actions()[explore]
+        return actions
+
+
+def generate(config, configfile, directory, n_steps, behaviour='random', epsilon=0.0, shard_size=1 << 16,
+             chunk_steps=4096, checkpoint_dir=None):
+    """Rolls a behaviour policy over all houses with one VecProgressusEnv and writes n_steps transitions
+    per house into the shards of <directory>/house_<i>. Transitions are gathered chunk_steps at a
+    time and written with one slice assignment per house and field. checkpoint_dir holds the
+    trained policies of the 'policy' behaviour."""
+    from house import VecProgressusEnv
+    n_house = int(config.get('Simulation', 'n_house'))
+    episode_steps = int(config.get('DRL', 'Max_Episode'))
+    env = VecProgressusEnv(global_seed=int(config.get('Simulation', 'global_seed')), configfile=configfile,
+                           n_agents=n_house, max_episode_steps=episode_steps)
+    policy = Behaviour(behaviour, env, epsilon, checkpoint_dir)
+    obs_dim = env.observation_space.shape[0]
+    writers = [ShardWriter(house_dir(directory, h), obs_dim, shard_size) for h in range(n_house)]
+
+    chunk = {name: np.zeros((chunk_steps, n_house) + ((obs_dim,) if name.endswith('states') else ()), dtype=dtype)
+             for name, dtype in FIELDS}
+    state = env.reset()
+    policy.begin_episode(episode_steps)
+    t_episode = 0
+    k = 0
+    for step in range(n_steps):
+        action = policy.act(t_episode, state)
+        next_state, reward, done, _ = env.step(action)
+        for name, value in zip(('states', 'actions', 'rewards', 'next_states', 'dones'),
+                               (state, action, reward, next_state, done)):
+            chunk[name][k] = value
+        k += 1
+        t_episode += 1
+        state = next_state
+        if done.all():
+            state = env.reset()
+            policy.begin_episode(episode_steps)
+            t_episode = 0
+        if k == chunk_steps or step == n_steps - 1:
+            for h, writer in enumerate(writers):
+                writer.append(**{name: array[:k, h] for name, array in chunk.items()})
+            k = 0
+    for writer in writers:
+        writer.close()
+    print("Offline dataset:", n_steps, "transitions per house,", behaviour, "behaviour, in", directory)
+
+
+def run_offline(config, configfile):
+    """Offline training mode: every house trains its DSAC (with the CQL regularizer) on minibatches
+    streamed from its shards, without stepping an environment; houses are federated after every episode."""
+    from house import VecProgressusEnv
+    from Agent import DSAC
+    from federation import FederatedAverage
+    from utils import config_int
+
+    n_house = int(config.get('Simulation', 'n_house'))
+    n_fed_episodes = int(config.get('DRL', 'n_episodes'))
+    updates = config_int(config, 'DRL', 'offline_updates', config.get('DRL', 'Max_Episode'), minimum=1)
+    gradient_steps = config_int(config, 'DRL', 'gradient_steps', 1, minimum=1)
+    directory = config.get('DRL', 'offline_dir', fallback='Data/offline')
+    env = VecProgressusEnv(global_seed=int(config.get('Simulation', 'global_seed')), configfile=configfile,
+                           n_agents=n_house)
+    agents = [DSAC(env, config, h) for h in range(n_house)]
+    datasets = [ShardedDataset(house_dir(directory, h), batch_size=256, device=agents[h].device)
+                for h in range(n_house)]
+    aggregator = FederatedAverage(agents) if n_house > 1 else None
+
+    for j in range(n_fed_episodes):
+        print("Episode = ", j, "/", n_fed_episodes)
+        losses = np.zeros((n_house, 2))
+        for h, (agent, dataset) in enumerate(zip(agents, datasets)):
+            # blocks of gradient_steps updates, the last one cut to offline_updates in total
+            for step in range(0, updates, gradient_steps):
+                out = agent.learn_block(step, dataset.sample(min(gradient_steps, updates - step)), gamma=0.99)
+            losses[h] = out[0], out[2]
+        print("actor loss {:.4f}, critic loss {:.4f}".format(*losses.mean(0)))
+        if aggregator is not None:
+            aggregator.aggregate([len(dataset) for dataset in datasets])
+    return agents
@@ -0,0 +1,91 @@
+import numpy as np
+
+from dataset import PRICE, CONSUMPTION, PRODUCTION
+from house import house_step
+
+ACTIONS = np.arange(5)
+
+
+def _interpolate(values, battery, step):
+    """Linear interpolation of values (n_house, n_levels), given on the battery grid, at battery (n_house, ...)."""
+    n_house, n_levels = values.shape
+    x = battery.reshape(n_house, -1) / step
+    i0 = np.clip(np.floor(x).astype(np.int64), 0, n_levels - 2)
+    w = x - i0
+    v0 = np.take_along_axis(values, i0, axis=1)
+    v1 = np.take_along_axis(values, i0 + 1, axis=1)
+    return (v0 + w * (v1 - v0)).reshape(battery.shape)
+
+
+def solve(data, sell_price, battery_capacity=2, n_levels=201, start_row=0, horizon=None, initial_battery=0.0,
+          gamma=1.0):
+    """Optimal battery schedule of every house by finite-horizon dynamic programming.
+    The ProgressusEnv dynamics are deterministic given the data, so the value of every battery level
+    of a grid of n_levels points in [0, battery_capacity] is computed backward in time for all houses
+    and all 5 actions at once; the value of the (off-grid) battery level an action leads to is
+    interpolated linearly on the grid. The schedule is then rolled forward from initial_battery
+    with the exact continuous dynamics, picking at every step the action of best reward plus value.
+    Params
+    ======
+        data (np.ndarray): (n_house, T, 4) dataset of VecProgressusEnv
+        sell_price (np.ndarray): (n_house, T) selling price
+        battery_capacity (float): capacity of the battery (kWh)
+        n_levels (int): points of the battery grid
+        start_row, horizon (int): rows start_row .. start_row + horizon - 1 (wrapping), all of them if None
+        initial_battery (float or np.ndarray): battery level at start_row
+        gamma (float): discount factor, 1 for the total reward
+    Returns
+    ======
+        dict of the schedule (actions, rewards, batteries, co2 of shape (n_house, horizon)), its total
+        reward `value` (n_house,), the DP estimate `dp_value` (n_house,) and the value function
+        `values` (horizon + 1, n_house, n_levels)
+    """
+    n_house, T = data.shape[0], data.shape[1]
+    horizon = T - start_row if horizon is None else horizon
+    rows = (start_row + np.arange(horizon)) % T
+    price = data[:, rows, PRICE]
+    consumption = data[:, rows, CONSUMPTION]
+    production = data[:, rows, PRODUCTION]
+    sell = sell_price[:, rows]
+    grid = np.linspace(0, battery_capacity, n_levels)
+    step = grid[1] - grid[0]
+
+    # backward pass over (house, battery level, action)
+    values = np.zeros((horizon + 1, n_house, n_levels))
+    battery = grid[None, :, None]
+    for t in range(horizon - 1, -1, -1):
+        reward, next_battery, _ = house_step(ACTIONS, battery, price[:, t, None, None], consumption[:, t, None, None],
+                                             production[:, t, None, None], sell[:, t, None, None], battery_capacity)
+        next_battery = np.broadcast_to(next_battery, (n_house, n_levels, len(ACTIONS)))
+        q = reward + gamma * _interpolate(values[t + 1], next_battery, step)
+        values[t] = q.max(2)
+
+    # forward pass with the exact dynamics
+    actions = np.zeros((n_house, horizon), dtype=np.int64)
+    rewards = np.zeros((n_house, horizon))
+    batteries = np.zeros((n_house, horizon))
+    co2 = np.zeros((n_house, horizon))
+    battery = np.broadcast_to(np.asarray(initial_battery, dtype=np.float64), (n_house,)).copy()
+    houses = np.arange(n_house)
+    for t in range(horizon):
+        reward, next_battery, co2_kg = house_step(ACTIONS, battery[:, None], price[:, t, None],
+                                                  consumption[:, t, None], production[:, t, None],
+                                                  sell[:, t, None], battery_capacity)
+        next_battery = np.broadcast_to(next_battery, (n_house, len(ACTIONS)))
+        action = (reward + gamma * _interpolate(values[t + 1], next_battery, step)).argmax(1)
+        actions[:, t] = action
+        rewards[:, t] = reward[houses, action]
+        battery = next_battery[houses, action]
+        batteries[:, t] = battery
+        co2[:, t] = np.broadcast_to(co2_kg, (n_house, len(ACTIONS)))[houses, action]
+
+    discount = gamma ** np.arange(horizon)
+    dp_value = _interpolate(values[0], np.broadcast_to(np.asarray(initial_battery, dtype=np.float64),
+                                                       (n_house,)).reshape(n_house, 1), step)[:, 0]
+    return dict(actions=actions, rewards=rewards, batteries=batteries, co2=co2,
+                value=(rewards * discount).sum(1), dp_value=dp_value, values=values)
+
+
+def solve_env(env, **kwargs):
+    """solve() over the data of a VecProgressusEnv."""
+    return solve(env.data, env.sell_price, battery_capacity=env.batteryCapacity, **kwargs)
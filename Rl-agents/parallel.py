@@ -0,0 +1,262 @@
+import configparser
+import copy
+import os
+import time
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+
+from federation import agent_parameters, parameters_to_vector, vector_to_parameters_
+
+
+def _build_agents(configfile, houses, n_house):
+    """Environments and Multi_Agents of a group of houses, as main.py builds them."""
+    import gym
+    from house import registration
+    from Agent import DSAC
+    from MultiAgent import Multi_Agent
+
+    config = configparser.RawConfigParser(defaults=None, strict=False)
+    config.read(configfile)
+    config_name = configfile.replace('/', ',').replace('.', ',').split(',')[1]
+    global_seed = int(config.get('Simulation', 'global_seed'))
+    registration(int(config.get('DRL', 'Max_Episode')))
+    agents = {}
+    for i in houses:
+        env = gym.make('Progressus-v0', global_seed=global_seed, configfile=configfile, agent_id=i, n_agents=n_house)
+        agents[i] = Multi_Agent(DSAC, env, config, config_name, i)
+    return config, agents
+
+
+def _warm_up(config, configfile, agents, n_house):
+    """Warms up the buffers of a group of houses with one vectorized rollout over all houses."""
+    from house import VecProgressusEnv
+    from utils import collect_random_vec
+
+    vec_env = VecProgressusEnv(global_seed=int(config.get('Simulation', 'global_seed')), configfile=configfile,
+                               n_agents=n_house, max_episode_steps=int(config.get('DRL', 'Max_Episode')))
+    n_warmup = next(iter(agents.values())).n_warmup
+    collect_random_vec(vec_env, [agents[i].buffer if i in agents else None for i in range(n_house)], n_warmup)
+    for agent in agents.values():
+        agent.warmed_up = True
+
+
+def house_actors(matrix, actor):
+    """networks.Actor of every house from the rows of a (n_house, n_params) matrix of flat agent
+    parameters (federation.agent_parameters, which starts with the actor); actor gives the shapes."""
+    n_actor = sum(p.numel() for p in actor.parameters())
+    actors = []
+    for row in matrix:
+        house = copy.deepcopy(actor)
+        with torch.no_grad():
+            vector_to_parameters_(row[:n_actor], [p.data for p in house.parameters()])
+        actors.append(house)
+    return actors
+
+
+def _worker(configfile, houses, n_house, n_threads, shared_matrix, global_vector, conn):
+    """Worker process owning a group of houses: their envs and buffers stay resident between
+    federation rounds and the weights are exchanged through the shared tensors."""
+    torch.set_num_threads(n_threads)
+    config, agents = _build_agents(configfile, houses, n_house)
+    params = {i: agent_parameters(agent.agents) for i, agent in agents.items()}
+    _warm_up(config, configfile, agents, n_house)
+    conn.send('ready')
+
+    while True:
+        cmd = conn.recv()
+        if cmd == 'run':
+            stats = {}
+            for i, agent in agents.items():
+                agent.run()
+                with torch.no_grad():
+                    parameters_to_vector(params[i], out=shared_matrix[i])
+                stats[i] = (len(agent.buffer), agent.agents.best_score)
+            conn.send(stats)
+        elif cmd == 'pull':
+            with torch.no_grad():
+                for i in agents:
+                    vector_to_parameters_(global_vector, params[i])
+            conn.send('ok')
+        elif cmd == 'push':
+            with torch.no_grad():
+                for i, agent in agents.items():
+                    parameters_to_vector(params[i], out=shared_matrix[i])
+            conn.send('ok')
+        elif cmd == 'stop':
+            break
+
+
+class ParallelTrainer:
+    """Parallel training mode: one worker process per group of houses.
+    Every round the workers train their houses for one federation episode and write the
+    house weights into a (n_house, n_params) tensor in shared memory; the parent averages
+    them (FDRL_Strategy = Average) into a shared global vector the workers load back."""
+
+    def __init__(self, configfile, n_house, n_workers):
+        """Params
+        ======
+            configfile (str): path of the properties file
+            n_house (int): number of houses
+            n_workers (int): number of worker processes, houses are split in contiguous groups
+        """
+        self.n_house = n_house
+        self.n_workers = min(n_workers, n_house)
+        # one reference agent gives the size of the flat parameter vector and the common initial weights
+        _, reference = _build_agents(configfile, [0], n_house)
+        self.actor = reference[0].agents.actor_local
+        init = parameters_to_vector(agent_parameters(reference[0].agents))
+        self.shared_matrix = torch.zeros(n_house, init.numel()).share_memory_()
+        self.global_vector = init.clone().share_memory_()
+
+        ctx = mp.get_context('spawn')
+        n_threads = max(1, (os.cpu_count() or 1) // self.n_workers)
+        self.groups = np.array_split(np.arange(n_house), self.n_workers)
+        self.conns = []
+        self.processes = []
+        for houses in self.groups:
+            parent_conn, child_conn = ctx.Pipe()
+            p = ctx.Process(target=_worker, args=(configfile, [int(i) for i in houses], n_house, n_threads,
+                                                  self.shared_matrix, self.global_vector, child_conn),
+                            daemon=True)
+            p.start()
+            self.conns.append(parent_conn)
+            self.processes.append(p)
+        for conn in self.conns:
+            conn.recv()
+        self._broadcast('pull')
+
+    def _broadcast(self, cmd):
+        for conn in self.conns:
+            conn.send(cmd)
+        replies = {}
+        for conn in self.conns:
+            reply = conn.recv()
+            if isinstance(reply, dict):
+                replies.update(reply)
+        return replies
+
+    def round(self, federate=True):
+        """Trains every house for one federation episode in parallel, then averages the houses.
+        Returns {house: (buffer size, score)}."""
+        stats = self._broadcast('run')
+        if federate:
+            weights = torch.tensor([stats[i][0] for i in range(self.n_house)], dtype=torch.float32)
+            with torch.no_grad():
+                torch.mv(self.shared_matrix.t(), weights / weights.sum(), out=self.global_vector)
+            self._broadcast('pull')
+        return stats
+
+    def actors(self):
+        """Current actor of every house, e.g. to save the trained policies."""
+        self._broadcast('push')
+        return house_actors(self.shared_matrix, self.actor)
+
+    def close(self):
+        for conn in self.conns:
+            conn.send('stop')
+        for p in self.processes:
+            p.join()
+
+
+def staleness_weight(alpha, staleness, exponent):
+    """Mixing weight of an update computed on a global model `staleness` versions old."""
+    return alpha * (1.0 + staleness) ** (-exponent)
+
+
+def _async_worker(configfile, houses, n_house, n_threads, n_episodes, alpha, exponent,
+                  global_vector, house_matrix, version, lock, queue):
+    """Asynchronous worker: every house pulls the latest global model, trains one federation
+    episode and mixes its weights into the global model with a staleness-dependent weight."""
+    torch.set_num_threads(n_threads)
+    config, agents = _build_agents(configfile, houses, n_house)
+    params = {i: agent_parameters(agent.agents) for i, agent in agents.items()}
+    _warm_up(config, configfile, agents, n_house)
+    local = torch.empty_like(global_vector)
+    for episode in range(n_episodes):
+        for i, agent in agents.items():
+            with lock:
+                base_version = version.value
+                local.copy_(global_vector)
+            with torch.no_grad():
+                vector_to_parameters_(local, params[i])
+            agent.run()
+            with torch.no_grad():
+                parameters_to_vector(params[i], out=local)
+                house_matrix[i].copy_(local)
+                with lock:
+                    staleness = version.value - base_version
+                    weight = staleness_weight(alpha, staleness, exponent)
+                    global_vector.lerp_(local, weight)
+                    version.value += 1
+            queue.put((i, episode, staleness, weight, agent.agents.best_score))
+    queue.put(None)
+
+
+class AsyncFederation:
+    """FDRL_Strategy = Async: houses train in worker processes and push their weights into the
+    shared global model as soon as they finish an episode, with a weight alpha / (1 + staleness)^exponent
+    where the staleness counts the global updates made since the house pulled. Houses pull the
+    latest global weights before every episode, nobody waits for the slowest house."""
+
+    def __init__(self, configfile, n_house, n_workers, alpha=0.6, exponent=0.5):
+        self.configfile = configfile
+        self.n_house = n_house
+        self.n_workers = min(n_workers, n_house)
+        self.alpha = alpha
+        self.exponent = exponent
+        _, reference = _build_agents(configfile, [0], n_house)
+        self.actor = reference[0].agents.actor_local
+        self.global_vector = parameters_to_vector(agent_parameters(reference[0].agents)).clone().share_memory_()
+        # weights of every house after its last episode
+        self.house_matrix = torch.zeros(n_house, self.global_vector.numel()).share_memory_()
+
+    def run(self, n_episodes):
+        """Trains every house for n_episodes. Returns the throughput and staleness statistics."""
+        ctx = mp.get_context('spawn')
+        version = ctx.Value('l', 0, lock=False)
+        lock = ctx.Lock()
+        queue = ctx.Queue()
+        n_threads = max(1, (os.cpu_count() or 1) // self.n_workers)
+        processes = []
+        for houses in np.array_split(np.arange(self.n_house), self.n_workers):
+            p = ctx.Process(target=_async_worker,
+                            args=(self.configfile, [int(i) for i in houses], self.n_house, n_threads, n_episodes,
+                                  self.alpha, self.exponent, self.global_vector, self.house_matrix, version, lock,
+                                  queue),
+                            daemon=True)
+            p.start()
+            processes.append(p)
+
+        start = None
+        updates = []
+        running = len(processes)
+        while running:
+            msg = queue.get()
+            if msg is None:
+                running -= 1
+                continue
+            if start is None:
+                start = time.time()
+            updates.append(msg)
+            print("house {} episode {} score {:.4f}, staleness {}".format(msg[0], msg[1], msg[4], msg[2]))
+        elapsed = time.time() - start if start is not None else 0.0
+        for p in processes:
+            p.join()
+        return self.report(updates, elapsed)
+
+    def actors(self):
+        """Actor of every house after its last episode, e.g. to save the trained policies."""
+        return house_actors(self.house_matrix, self.actor)
+
+    def report(self, updates, elapsed):
+        staleness = np.array([u[2] for u in updates], dtype=np.float64)
+        stats = dict(updates=len(updates),
+                     updates_per_s=len(updates) / elapsed if elapsed > 0 else float('nan'),
+                     rounds_per_s=len(updates) / self.n_house / elapsed if elapsed > 0 else float('nan'),
+                     staleness_mean=staleness.mean() if len(staleness) else 0.0,
+                     staleness_max=staleness.max() if len(staleness) else 0.0,
+                     staleness_p95=np.percentile(staleness, 95) if len(staleness) else 0.0)
+        print("Async federation: {updates} updates, {updates_per_s:.2f} updates/s, {rounds_per_s:.3f} rounds/s, "
+              "staleness mean {staleness_mean:.2f} / p95 {staleness_p95:.1f} / max {staleness_max:.0f}".format(**stats))
+        return stats
@@ -0,0 +1,188 @@
+import numpy as np
+import torch
+import torch.optim as optim
+
+from networks import EnsembleCritic, StackedActor, soft_update
+from utils import config_int
+
+
+class PopulationDSAC:
+    """DSAC for a whole population of houses as one model: the actor, twin critics and target
+    critics of every house are stacked along a leading house dimension, so the updates of all
+    houses run as one batched forward/backward. The losses of the houses are summed, which keeps
+    their gradients (and, Adam being elementwise, their optimizer steps) separate: every house
+    still trains its own weights, as n_house DSAC agents would."""
+
+    def __init__(self, n_house, state_size, action_size, hidden_size=256, learning_rate=5e-4, gamma=0.99,
+                 tau=1e-2, device=None):
+        self.n_house = n_house
+        self.state_size = state_size
+        self.action_size = action_size
+        self.gamma = gamma
+        self.tau = tau
+        self.clip_grad_param = 1
+        self.device = device if device is not None else torch.device("cpu")
+        self.target_entropy = -action_size  # -dim(A)
+
+        self.actor = StackedActor(n_house, state_size, action_size, hidden_size).to(self.device)
+        # twin critics: member m of house h is member 2 * h + m of the ensemble
+        self.critic = EnsembleCritic(state_size, action_size, hidden_size, 2 * n_house).to(self.device)
+        self.critic_target = EnsembleCritic(state_size, action_size, hidden_size, 2 * n_house).to(self.device)
+        self.critic_target.load_state_dict(self.critic.state_dict())
+
+        self.log_alpha = torch.zeros(n_house, 1, device=self.device, requires_grad=True)
+        self.alpha = self.log_alpha.exp().detach()
+
+        self.actor_optimizer = optim.Adam(self.actor.parameters(), lr=learning_rate)
+        self.critic_optimizer = optim.Adam(self.critic.parameters(), lr=learning_rate)
+        self.alpha_optimizer = optim.Adam([self.log_alpha], lr=learning_rate)
+
+    def action_probs(self, states):
+        """states (n_house, batch, state_size) -> action probabilities and their logs (n_house, batch, action_size)."""
+        probs = self.actor(states)
+        z = (probs == 0.0).float() * 1e-8
+        return probs, torch.log(probs + z)
+
+    def q_values(self, critic, states):
+        """Q-values of both critics of every house: (n_house, 2, batch, action_size)."""
+        x = states.unsqueeze(1).expand(-1, 2, -1, -1).reshape(2 * self.n_house, *states.shape[1:])
+        return critic(x).view(self.n_house, 2, states.shape[1], self.action_size)
+
+    def get_actions(self, states):
+        """Samples one action per house for states (n_house, state_size)."""
+        return self.actor.get_actions(states)
+
+    def learn(self, experiences):
+        """One DSAC (+CQL regularizer) update of every house.
+        Params
+        ======
+            experiences (Tuple[torch.Tensor]): (s, a, r, s', done) tensors of shape (n_house, batch, ...)
+        Returns
+        ======
+            per-house actor, alpha and critic losses
+        """
+        states, actions, rewards, next_states, dones = experiences
+
+        # ---------------------------- update actor ---------------------------- #
+        probs, log_pis = self.action_probs(states)
+        with torch.no_grad():
+            min_Q = self.q_values(self.critic, states).min(1)[0]
+        actor_loss = (probs * (self.alpha.unsqueeze(-1) * log_pis - min_Q)).sum(-1).mean(-1)
+        self.actor_optimizer.zero_grad()
+        actor_loss.sum().backward()
+        self.actor_optimizer.step()
+
+        log_action_pi = (log_pis * probs).sum(-1).detach()
+        alpha_loss = -(self.log_alpha.exp() * (log_action_pi + self.target_entropy)).mean(-1)
+        self.alpha_optimizer.zero_grad()
+        alpha_loss.sum().backward()
+        self.alpha_optimizer.step()
+        self.alpha = self.log_alpha.exp().detach()
+
+        # ---------------------------- update critic ---------------------------- #
+        with torch.no_grad():
+            next_probs, next_log_pis = self.action_probs(next_states)
+            Q_target_next = next_probs * (self.q_values(self.critic_target, next_states).min(1)[0]
+                                          - self.alpha.unsqueeze(-1) * next_log_pis)
+            Q_targets = rewards + self.gamma * (1 - dones) * Q_target_next.sum(-1, keepdim=True)
+
+        q = self.q_values(self.critic, states)
+        q_ = q.gather(-1, actions.long().unsqueeze(1).expand(-1, 2, -1, -1))
+        critic_loss = 0.5 * (q_ - Q_targets.unsqueeze(1)).pow(2).mean((-1, -2))
+        cql_loss = torch.logsumexp(q, dim=-1).mean(-1) - q.mean((-1, -2))
+        self.critic_optimizer.zero_grad()
+        (critic_loss + cql_loss).sum().backward()
+        self.critic.clip_grad_norm_(self.clip_grad_param)
+        self.critic_optimizer.step()
+
+        # ----------------------- update target networks ----------------------- #
+        soft_update(self.critic, self.critic_target, self.tau)
+
+        return (actor_loss.detach().cpu().numpy(), alpha_loss.detach().cpu().numpy(),
+                critic_loss.detach().cpu().numpy())
+
+    def actor_modules(self):
+        """Actor of every house as a networks.Actor, e.g. to save the trained policies."""
+        from networks import Actor
+        actors = []
+        for h in range(self.n_house):
+            actor = Actor(self.state_size, self.action_size, self.actor.weight0.shape[1])
+            with torch.no_grad():
+                for k, layer in enumerate((actor.fc1, actor.fc2, actor.fc3)):
+                    layer.weight.copy_(getattr(self.actor, 'weight' + str(k))[h])
+                    layer.bias.copy_(getattr(self.actor, 'bias' + str(k))[h, 0])
+            actors.append(actor)
+        return actors
+
+    def federate(self, weights=None):
+        """FDRL_Strategy = Average over the house dimension: every house gets the weighted
+        average of the actors, critics and target critics of all houses."""
+        weights = np.ones(self.n_house) if weights is None else np.asarray(weights, dtype=np.float64)
+        w = torch.as_tensor(weights / weights.sum(), dtype=torch.float32, device=self.device)
+        with torch.no_grad():
+            for module, per_house in ((self.actor, 1), (self.critic, 2), (self.critic_target, 2)):
+                for p in module.parameters():
+                    stacked = p.data.view(self.n_house, per_house, *p.shape[1:])
+                    mean = torch.tensordot(w, stacked, dims=1)
+                    stacked.copy_(mean.unsqueeze(0).expand_as(stacked))
+
+
+def run_population(config, configfile, metrics=None):
+    """Population training mode: all houses step one VecProgressusEnv and learn with one PopulationDSAC.
+    The steps and episodes of every house are recorded into metrics (a metrics.MetricsSink) if given."""
+    from house import VecProgressusEnv
+    from buffer import StackedReplayBuffer
+
+    n_house = int(config.get('Simulation', 'n_house'))
+    n_decisions_per_episode = int(config.get('DRL', 'Max_Episode'))
+    n_fed_episodes = int(config.get('DRL', 'n_episodes'))
+    n_warmup = config_int(config, 'DRL', 'n_warmup', 1000, minimum=0)
+    gradient_steps = config_int(config, 'DRL', 'gradient_steps', 1, minimum=1)
+    learn_every = config_int(config, 'DRL', 'learn_every', 1, minimum=1)
+    federate = n_house > 1 and config.get('DRL', 'FDRL_Strategy', fallback='Average').strip() == 'Average'
+    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+
+    env = VecProgressusEnv(global_seed=int(config.get('Simulation', 'global_seed')), configfile=configfile,
+                           n_agents=n_house, max_episode_steps=n_decisions_per_episode)
+    model = PopulationDSAC(n_house, env.observation_space.shape[0], env.action_space.n, device=device)
+    buffer = StackedReplayBuffer(n_house, buffer_size=100_000, batch_size=256, device=device)
+
+    state = env.reset()
+    for _ in range(n_warmup):
+        action = env.sample_actions()
+        next_state, reward, done, _ = env.step(action)
+        buffer.add(state, action, reward, next_state, done)
+        state = env.reset() if done.all() else next_state
+
+    houses = np.arange(n_house)
+    for j in range(n_fed_episodes):
+        print("Episode = ", j, "/", n_fed_episodes)
+        state = env.reset()
+        score = np.zeros(n_house)
+        diffpro_sum = np.zeros(n_house)
+        battery_sum = np.zeros(n_house)
+        if metrics is not None:
+            metrics.episode = j
+        steps = 0
+        done = np.zeros(n_house, dtype=bool)
+        while not done.all():
+            action = model.get_actions(state)
+            next_state, reward, done, info = env.step(action)
+            buffer.add(state, action, reward, next_state, done)
+            steps += 1
+            if steps % learn_every == 0:
+                for _ in range(gradient_steps):
+                    model.learn(buffer.sample())
+            state = next_state
+            score += reward
+            diffpro_sum += info['dic_diffpro']
+            battery_sum += info['dic_battery']
+            if metrics is not None:
+                metrics.log_steps(houses, steps, action, reward, info['dic_diffpro'], info['dic_battery'])
+        if metrics is not None:
+            for h in range(n_house):
+                metrics.log_episode(h, steps, score[h], diffpro_sum[h], battery_sum[h])
+        print("step------------------------------", steps, "mean score", score.mean())
+        if federate:
+            model.federate()
+    return model
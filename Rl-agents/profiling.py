@@ -0,0 +1,87 @@
+import json
+import time
+import torch
+
+# common origin of the trace timestamps of every house
+_T0 = time.perf_counter()
+
+
+class Profiler:
+    """Per-phase wall time and call counts of one house.
+    The hot path calls mark() once, then lap(phase) after every phase: the time since the previous
+    mark or lap is charged to that phase. Multi_Agent.run and DSAC.learn share the profiler of their
+    house, so the phases of the update are laps of the same timeline. When disabled, mark() and lap()
+    return immediately."""
+
+    def __init__(self, house=0, enabled=False, trace=False, max_trace_events=200_000):
+        """Params
+        ======
+            house (int): house the phases are charged to (the thread of the trace)
+            enabled (bool): record anything at all
+            trace (bool): also keep one event per lap for write_trace
+            max_trace_events (int): events kept per house, the later laps are only counted
+        """
+        self.house = house
+        self.enabled = enabled
+        self.trace = trace
+        self.max_trace_events = max_trace_events
+        # CUDA kernels run asynchronously: wait for them so they are charged to the phase that queued them
+        self.sync = enabled and torch.cuda.is_available()
+        self.stats = {}
+        self.events = []
+        self.last = 0.0
+
+    def mark(self):
+        if not self.enabled:
+            return
+        if self.sync:
+            torch.cuda.synchronize()
+        self.last = time.perf_counter()
+
+    def lap(self, phase):
+        if not self.enabled:
+            return
+        if self.sync:
+            torch.cuda.synchronize()
+        now = time.perf_counter()
+        stat = self.stats.get(phase)
+        if stat is None:
+            stat = self.stats[phase] = [0, 0.0]
+        stat[0] += 1
+        stat[1] += now - self.last
+        if self.trace and len(self.events) < self.max_trace_events:
+            self.events.append((phase, self.last, now))
+        self.last = now
+
+
+def profile_summary(profilers):
+    """Table of the phases over all houses: calls, total and mean time, share of the profiled time,
+    and the fastest and slowest house."""
+    phases = {}
+    for p in profilers:
+        for phase, (calls, total) in p.stats.items():
+            phases.setdefault(phase, []).append((p.house, calls, total))
+    grand_total = sum(total for rows in phases.values() for _, _, total in rows) or 1.0
+    lines = ["{:<24s} {:>10s} {:>10s} {:>10s} {:>7s} {:>18s}".format(
+        'phase', 'calls', 'total s', 'mean us', 'share', 'house min/max s')]
+    for phase, rows in sorted(phases.items(), key=lambda kv: -sum(r[2] for r in kv[1])):
+        calls = sum(r[1] for r in rows)
+        total = sum(r[2] for r in rows)
+        lines.append("{:<24s} {:>10d} {:>10.3f} {:>10.1f} {:>6.1f}% {:>8.3f}/{:<8.3f}".format(
+            phase, calls, total, 1e6 * total / max(calls, 1), 100 * total / grand_total,
+            min(r[2] for r in rows), max(r[2] for r in rows)))
+    return "\n".join(lines)
+
+
+def write_trace(path, profilers):
+    """Writes the recorded laps in the Chrome trace event format (chrome://tracing, Perfetto),
+    one thread per house."""
+    events = []
+    for p in profilers:
+        events.append({'name': 'thread_name', 'ph': 'M', 'pid': 0, 'tid': p.house,
+                       'args': {'name': 'house ' + str(p.house)}})
+        for phase, begin, end in p.events:
+            events.append({'name': phase, 'ph': 'X', 'pid': 0, 'tid': p.house,
+                           'ts': (begin - _T0) * 1e6, 'dur': (end - begin) * 1e6})
+    with open(path, 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
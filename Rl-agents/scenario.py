@@ -0,0 +1,48 @@
+import numpy as np
+
+from dataset import PRICE, CONSUMPTION, PRODUCTION
+from house import house_step
+
+
+def rollout_schedules(actions, data, sell_price, start_row=0, initial_battery=0.0, battery_capacity=2):
+    """Scores open-loop action schedules of one house with the ProgressusEnv.step arithmetic,
+    vectorized over the candidates: one house_step call per time step for all of them.
+    Params
+    ======
+        actions (np.ndarray): (n_candidates, horizon) actions in {0, ..., 4}
+        data (np.ndarray): (T, 4) dataset of the house (ProgressusEnv.data)
+        sell_price (np.ndarray): (T,) selling price (ProgressusEnv.sell_price)
+        start_row (int): row of the first action, the rows wrap around the dataset
+        initial_battery (float): battery level before the first action (kWh)
+        battery_capacity (float): capacity of the battery (kWh)
+    Returns
+    ======
+        dict of (n_candidates, horizon) rewards, co2 (kg) and batteries (level after every action),
+        and the (n_candidates,) total reward
+    """
+    actions = np.asarray(actions)
+    n_candidates, horizon = actions.shape
+    rows = (start_row + np.arange(horizon)) % data.shape[0]
+    price = data[rows, PRICE]
+    consumption = data[rows, CONSUMPTION]
+    production = data[rows, PRODUCTION]
+    sell = sell_price[rows]
+
+    rewards = np.empty((n_candidates, horizon))
+    co2 = np.empty((n_candidates, horizon))
+    batteries = np.empty((n_candidates, horizon))
+    battery = np.full(n_candidates, initial_battery, dtype=np.float64)
+    for t in range(horizon):
+        rewards[:, t], battery, co2[:, t] = house_step(actions[:, t], battery, price[t], consumption[t],
+                                                       production[t], sell[t], battery_capacity)
+        batteries[:, t] = battery
+    return dict(rewards=rewards, co2=co2, batteries=batteries, total=rewards.sum(1))
+
+
+def rollout_env(env, actions, start_row=None, initial_battery=None):
+    """rollout_schedules() from the data of a ProgressusEnv, by default from its current row and battery."""
+    env = env.unwrapped
+    return rollout_schedules(actions, env.data, env.sell_price,
+                             env.currentState_row if start_row is None else start_row,
+                             env.currentState_battery if initial_battery is None else initial_battery,
+                             env.batteryCapacity)
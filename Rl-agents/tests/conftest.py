@@ -0,0 +1,19 @@
+import os
+import sys
+import pytest
+
+RL_AGENTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, RL_AGENTS)
+
+TRAIN_DATA = os.path.join(RL_AGENTS, 'Data', 'select_train_data_30m_2.csv')
+
+
+@pytest.fixture
+def configfile(tmp_path, request):
+    """Path of a throwaway config training on TRAIN_DATA. Its [DRL] options are the dict given with
+    @pytest.mark.parametrize('configfile', [{...}], indirect=True), none by default."""
+    drl = getattr(request, 'param', {})
+    path = tmp_path / 'test.properties'
+    path.write_text('[Simulation]\nenvTrain = ' + TRAIN_DATA + '\n[DRL]\n'
+                    + ''.join('{} = {}\n'.format(key, value) for key, value in drl.items()))
+    return str(path)
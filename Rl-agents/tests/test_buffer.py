@@ -0,0 +1,99 @@
+import numpy as np
+import pytest
+import torch
+
+from buffer import SumTree, PrioritizedReplayBuffer
+
+
+def assert_consistent(tree):
+    """Every internal node is the sum of its children."""
+    nodes = np.arange(1, tree.n_leaves)
+    np.testing.assert_allclose(tree.tree[nodes], tree.tree[2 * nodes] + tree.tree[2 * nodes + 1])
+
+
+def test_find_is_proportional_to_priority():
+    priorities = np.array([0.5, 0.0, 2.0, 1.0, 0.0, 3.5, 0.25])
+    tree = SumTree(len(priorities))
+    tree.update(np.arange(len(priorities)), priorities)
+    assert_consistent(tree)
+    assert tree.total == pytest.approx(priorities.sum())
+
+    # the middle of every slot's interval of cumulative priority maps to that slot
+    ends = np.cumsum(priorities)
+    nonzero = priorities > 0
+    np.testing.assert_array_equal(tree.find((ends - priorities / 2)[nonzero]), np.nonzero(nonzero)[0])
+
+    counts = np.bincount(tree.find(np.random.RandomState(0).rand(200_000) * tree.total), minlength=len(priorities))
+    assert counts[~nonzero].sum() == 0
+    np.testing.assert_allclose(counts / counts.sum(), priorities / priorities.sum(), atol=5e-3)
+
+
+def test_batched_update_with_duplicate_indices():
+    rng = np.random.RandomState(1)
+    tree = SumTree(100)
+    reference = SumTree(100)
+    for _ in range(20):
+        idx = rng.randint(0, 100, size=64)  # with repeats
+        priorities = rng.rand(64)
+        tree.update(idx, priorities)
+        for i in np.unique(idx):
+            # NumPy assignment keeps the last of the repeated indices
+            reference.set(i, priorities[np.nonzero(idx == i)[0][-1]])
+        assert_consistent(tree)
+        np.testing.assert_allclose(tree.tree, reference.tree)
+
+
+def filled_buffer(n=1000, size=4096, **kwargs):
+    buffer = PrioritizedReplayBuffer(buffer_size=size, batch_size=64, device=torch.device('cpu'), **kwargs)
+    rng = np.random.RandomState(2)
+    buffer.add_batch(rng.rand(n, 4).astype(np.float32), rng.randint(0, 5, n), rng.rand(n).astype(np.float32),
+                     rng.rand(n, 4).astype(np.float32), np.zeros(n, dtype=np.float32))
+    return buffer
+
+
+def test_stratified_sampling():
+    buffer = filled_buffer()
+    td_errors = np.random.RandomState(3).rand(len(buffer)) * 10
+    buffer.update_priorities(np.arange(len(buffer)), td_errors)
+    idx = buffer.sample_indices(64)
+    # one index per stratum of cumulative priority, so they come out in slot order
+    assert np.all(np.diff(idx) >= 0)
+    assert np.all(idx < len(buffer))
+    # the interval of cumulative priority of the k-th index overlaps the k-th stratum
+    leaves = buffer.tree.leaves(np.arange(len(buffer)))
+    ends = np.cumsum(leaves)
+    segment = buffer.tree.total / 64
+    k = np.arange(64)
+    assert np.all(ends[idx] > k * segment * (1 - 1e-12))
+    assert np.all(ends[idx] - leaves[idx] < (k + 1) * segment * (1 + 1e-12))
+
+
+def test_importance_weights_are_normalized():
+    buffer = filled_buffer(beta=0.4, beta_increment=0.0)
+    buffer.update_priorities(np.arange(len(buffer)), np.random.RandomState(4).rand(len(buffer)))
+    np.random.seed(5)
+    _, weights, idx = buffer.sample()
+    probs = buffer.tree.leaves(idx) / buffer.tree.total
+    expected = (len(buffer) * probs) ** -0.4
+    weights = weights.numpy()[:, 0]
+    assert weights.max() == pytest.approx(1.0)
+    np.testing.assert_allclose(weights, expected / expected.max(), rtol=1e-5)
+
+
+def test_share_next_state_never_samples_invalid_slots():
+    buffer = PrioritizedReplayBuffer(buffer_size=16, batch_size=32, device=torch.device('cpu'), share_next_state=True)
+    state = np.zeros(4, dtype=np.float32)
+    for t in range(40):
+        # a new episode every 5 steps: the last transition of the previous one loses its next_state
+        if t % 5 == 0:
+            state = np.full(4, 1000 + t, dtype=np.float32)
+        next_state = state + 1
+        buffer.add(state, t % 5, 0.0, next_state, False)
+        state = next_state
+        invalid = np.nonzero(~buffer.valid[:buffer.size])[0]
+        assert np.all(buffer.tree.leaves(invalid) == 0)
+    np.random.seed(6)
+    for _ in range(50):
+        (states, _, _, next_states, _), _, idx = buffer.sample()
+        assert buffer.valid[idx].all()
+        np.testing.assert_array_equal(next_states.numpy(), states.numpy() + 1)
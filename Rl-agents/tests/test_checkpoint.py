@@ -0,0 +1,61 @@
+import random
+import numpy as np
+import pytest
+import torch
+
+import configparser
+import gym
+from Agent import DSAC
+from MultiAgent import Multi_Agent
+from checkpoint import Checkpoint
+from federation import FederatedAverage, agent_parameters, parameters_to_vector
+from house import registration, VecProgressusEnv
+from utils import collect_random_vec
+
+N_HOUSE = 2
+MAX_EPISODE = 8
+DRL = {'code_model': 'Train', '_class_ML': 'DSAC', 'Max_Episode': MAX_EPISODE, 'n_warmup': 300}
+
+
+def train(configfile, directory, stop, resume=False, compression='int8'):
+    """Trains N_HOUSE houses with a compressed federation up to episode stop, checkpointing every
+    episode, as main.py does. Returns the flat parameters of every house."""
+    random.seed(0)
+    np.random.seed(0)
+    torch.manual_seed(0)
+    config = configparser.RawConfigParser(defaults=None, strict=False)
+    config.read(configfile)
+    registration(MAX_EPISODE)
+    agents = []
+    for i in range(N_HOUSE):
+        env = gym.make('Progressus-v0', global_seed=0, configfile=configfile, agent_id=i, n_agents=N_HOUSE)
+        agents.append(Multi_Agent(DSAC, env, config, 'test', i))
+    if not resume:
+        # warm-up on NumPy's RNG, as main.py does (the gym action spaces have their own unseeded RNG)
+        vec_env = VecProgressusEnv(global_seed=0, configfile=configfile, n_agents=N_HOUSE,
+                                   max_episode_steps=MAX_EPISODE)
+        collect_random_vec(vec_env, [agent.buffer for agent in agents], num_samples=agents[0].n_warmup)
+        for agent in agents:
+            agent.warmed_up = True
+    aggregator = FederatedAverage([agent.agents for agent in agents], compression=compression)
+    checkpoint = Checkpoint(directory, every=1)
+    first_episode = 0
+    if resume:
+        first_episode, extra = checkpoint.load(agents)
+        aggregator.load_state_dict(extra['aggregator'])
+    for j in range(first_episode, stop):
+        for agent in agents:
+            agent.run()
+        aggregator.aggregate([len(agent.buffer) for agent in agents])
+        checkpoint.save(j, agents, extra={'aggregator': aggregator.state_dict()})
+    return [parameters_to_vector(agent_parameters(agent.agents)) for agent in agents]
+
+
+@pytest.mark.parametrize('configfile', [DRL], indirect=True, ids=['dsac'])
+@pytest.mark.parametrize('compression', ['none', 'int8'])
+def test_resume_matches_uninterrupted_run(configfile, tmp_path, compression):
+    straight = train(configfile, str(tmp_path / 'straight'), 4, compression=compression)
+    train(configfile, str(tmp_path / 'resumed'), 2, compression=compression)
+    resumed = train(configfile, str(tmp_path / 'resumed'), 4, resume=True, compression=compression)
+    for a, b in zip(straight, resumed):
+        assert torch.equal(a, b)
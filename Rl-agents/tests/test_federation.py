@@ -0,0 +1,46 @@
+import pytest
+import torch
+
+from federation import UpdateCodec
+
+N_PARAMS = 10_000  # not a multiple of the block size: the last int8 block is padded
+
+
+def test_int8_error_is_at_most_half_a_step_per_block():
+    generator = torch.Generator().manual_seed(0)
+    local, global_vector = torch.randn(N_PARAMS, generator=generator), torch.randn(N_PARAMS, generator=generator)
+    codec = UpdateCodec(N_PARAMS, method='int8', block_size=1024, error_feedback=False)
+    payload = codec.encode(local, global_vector)
+    _, q, scales = payload
+    assert q.dtype == torch.int8 and q.shape == (codec.n_blocks, 1024)
+    error = (local - global_vector - codec.decode(payload)).abs()
+    bound = scales.repeat_interleave(1024)[:N_PARAMS] / 2
+    assert torch.all(error <= bound * (1 + 1e-5))
+
+
+def test_topk_keeps_the_largest_entries_exactly():
+    generator = torch.Generator().manual_seed(1)
+    delta = torch.randn(N_PARAMS, generator=generator)
+    codec = UpdateCodec(N_PARAMS, method='topk', topk_ratio=0.01, error_feedback=False)
+    payload = codec.encode(delta, torch.zeros(N_PARAMS))
+    decoded = codec.decode(payload)
+    kept = decoded != 0
+    assert kept.sum() == codec.k == 100
+    torch.testing.assert_close(decoded[kept], delta[kept], rtol=0, atol=0)
+    assert delta[~kept].abs().max() <= delta[kept].abs().min()
+
+
+@pytest.mark.parametrize('method', ['int8', 'topk'])
+def test_error_feedback_tracks_the_cumulative_update(method):
+    generator = torch.Generator().manual_seed(2)
+    codec = UpdateCodec(N_PARAMS, method=method, topk_ratio=0.05, block_size=1024)
+    sent, received = torch.zeros(N_PARAMS), torch.zeros(N_PARAMS)
+    for _ in range(200):
+        delta = torch.randn(N_PARAMS, generator=generator) * 1e-2 + 1e-3
+        received += codec.decode(codec.encode(delta, torch.zeros(N_PARAMS)))
+        sent += delta
+        # whatever was not delivered yet is in the residual
+        torch.testing.assert_close(received + codec.residual, sent, rtol=0, atol=1e-4)
+    # the residual stays bounded while the cumulative update grows, so the delivered part follows it
+    assert codec.residual.abs().max() < 0.2 * sent.abs().max()
+    assert (received - sent).norm() < 0.1 * sent.norm()
@@ -0,0 +1,26 @@
+import itertools
+import numpy as np
+import pytest
+
+from house import VecProgressusEnv
+from oracle import solve_env
+from scenario import rollout_schedules
+
+SCHEDULES = np.array(list(itertools.product(range(5), repeat=6)))
+
+
+@pytest.fixture
+def env(configfile):
+    return VecProgressusEnv(global_seed=0, configfile=configfile, n_agents=3)
+
+
+@pytest.mark.parametrize('start_row, initial_battery', [(356, 0.0), (1482, 0.7), (2604, 1.9)])
+def test_oracle_matches_brute_force(env, start_row, initial_battery):
+    result = solve_env(env, start_row=start_row, horizon=6, initial_battery=initial_battery, n_levels=401)
+    for h in range(env.n_agents):
+        # all 5^6 schedules of the house
+        best = rollout_schedules(SCHEDULES, env.data[h], env.sell_price[h], start_row, initial_battery)['total'].max()
+        replay = rollout_schedules(result['actions'][h:h + 1], env.data[h], env.sell_price[h], start_row,
+                                   initial_battery)['total'][0]
+        assert replay == pytest.approx(result['value'][h], abs=1e-9)
+        assert result['value'][h] == pytest.approx(best, rel=1e-6, abs=1e-9)
@@ -0,0 +1,56 @@
+import numpy as np
+import torch
+
+from evaluation import load_policies, save_policies
+from networks import Actor, StackedActor
+
+N_HOUSE = 3
+
+
+def house_actors():
+    torch.manual_seed(0)
+    return [Actor(4, 5, 32) for _ in range(N_HOUSE)]
+
+
+def house_probs(actors, states):
+    with torch.no_grad():
+        return torch.stack([actor(torch.from_numpy(states[h])) for h, actor in enumerate(actors)])
+
+
+def random_states(seed):
+    return np.random.RandomState(seed).rand(N_HOUSE, 4).astype(np.float32) * np.float32([2, 100, 40, 24])
+
+
+def test_gather_matches_house_actors():
+    actors = house_actors()
+    states = random_states(0)
+    stacked = StackedActor(N_HOUSE, 4, 5, 32)
+    stacked.gather(actors)
+    with torch.no_grad():
+        torch.testing.assert_close(stacked(torch.from_numpy(states)), house_probs(actors, states))
+    actions = stacked.get_actions(states)
+    assert actions.shape == (N_HOUSE,) and ((0 <= actions) & (actions < 5)).all()
+
+
+def test_gather_copies_the_weights():
+    actors = house_actors()
+    states = random_states(1)
+    stacked = StackedActor(N_HOUSE, 4, 5, 32)
+    stacked.gather(actors)
+    # an optimizer step of one house: the stacked actor sees it after the next gather only
+    optimizer = torch.optim.Adam(actors[1].parameters(), lr=1e-2)
+    actors[1](torch.from_numpy(states[1]))[0].backward()
+    optimizer.step()
+    with torch.no_grad():
+        assert not torch.allclose(stacked(torch.from_numpy(states))[1], house_probs(actors, states)[1])
+        stacked.gather(actors)
+        torch.testing.assert_close(stacked(torch.from_numpy(states)), house_probs(actors, states))
+
+
+def test_load_policies_stacks_the_saved_actors(tmp_path):
+    actors = house_actors()
+    states = random_states(2)
+    save_policies(str(tmp_path), actors)
+    stacked = load_policies(str(tmp_path), N_HOUSE, 4, 5)
+    with torch.no_grad():
+        torch.testing.assert_close(stacked(torch.from_numpy(states)), house_probs(actors, states))
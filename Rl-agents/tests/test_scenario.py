@@ -0,0 +1,36 @@
+import copy
+import numpy as np
+import pytest
+
+from dataset import PRICE, CONSUMPTION, PRODUCTION
+from house import ProgressusEnv
+from scenario import rollout_env
+
+
+@pytest.fixture
+def env(configfile):
+    return ProgressusEnv(global_seed=0, configfile=configfile, agent_id=1, n_agents=3)
+
+
+@pytest.mark.parametrize('start_row, initial_battery', [(0, 0.0), (1480, 0.5), (2600, 1.9)])
+def test_rollout_matches_step(env, start_row, initial_battery):
+    rng = np.random.RandomState(start_row)
+    actions = rng.randint(0, 5, size=(64, 48))
+    # every action on its own, and the schedules that stay on one action
+    actions[:5] = np.arange(5)[:, None]
+
+    env.currentState_row = start_row
+    env.currentState_battery = initial_battery
+    env.currentState_price = env.data[start_row, PRICE]
+    env.currentState_consumption = env.data[start_row, CONSUMPTION]
+    env.currentState_panelProd = env.data[start_row, PRODUCTION]
+    result = rollout_env(env, actions)
+
+    for c in range(len(actions)):
+        candidate = copy.deepcopy(env)
+        for t, action in enumerate(actions[c]):
+            _, reward, _, info = candidate.step(int(action))
+            np.testing.assert_allclose(result['rewards'][c, t], reward, rtol=1e-9, atol=1e-12)
+            np.testing.assert_allclose(result['co2'][c, t], info['dic_diffpro'], rtol=1e-9, atol=1e-12)
+            np.testing.assert_allclose(result['batteries'][c, t], info['dic_battery'], rtol=1e-9, atol=1e-12)
+    np.testing.assert_allclose(result['total'], result['rewards'].sum(1))
@@ -1,3 +1,4 @@
+import numpy as np
 import torch
 
 def save(args, save_name, model, wandb, ep=None):
@@ -12,6 +13,13 @@ def save(args, save_name, model, wandb, ep=None):
         torch.save(model.state_dict(), save_dir + args.run_name + save_name + ".pth")
         wandb.save(save_dir + args.run_name + save_name + ".pth")
 
+def config_int(config, section, option, fallback, minimum):
+    """Integer option of the configuration, rejected with a ValueError below minimum."""
+    value = int(config.get(section, option, fallback=fallback))
+    if value < minimum:
+        raise ValueError(option + ' must be >= ' + str(minimum) + ', got ' + str(value))
+    return value
+
 def collect_random(env, dataset, num_samples=200):
     state = env.reset()
     for _ in range(num_samples):
@@ -21,3 +29,26 @@ def collect_random(env, dataset, num_samples=200):
         state = next_state
         if done:
             state = env.reset()
+
+def collect_random_vec(vec_env, datasets, num_samples=200):
+    """Random warm-up of every house at once: steps a VecProgressusEnv with random actions
+    and writes the transitions of house i into datasets[i] with a single add_batch.
+    Houses whose dataset is None are stepped but not recorded."""
+    n = vec_env.n_agents
+    obs_dim = vec_env.observation_space.shape[0]
+    states = np.zeros((num_samples, n, obs_dim), dtype=np.float32)
+    next_states = np.zeros((num_samples, n, obs_dim), dtype=np.float32)
+    actions = np.zeros((num_samples, n), dtype=np.int64)
+    rewards = np.zeros((num_samples, n), dtype=np.float32)
+    dones = np.zeros((num_samples, n), dtype=np.float32)
+    state = vec_env.reset()
+    for t in range(num_samples):
+        action = vec_env.sample_actions()
+        next_state, reward, done, _ = vec_env.step(action)
+        states[t], actions[t], rewards[t], next_states[t], dones[t] = state, action, reward, next_state, done
+        state = next_state
+        if done.all():
+            state = vec_env.reset()
+    for i, dataset in enumerate(datasets):
+        if dataset is not None:
+            dataset.add_batch(states[:, i], actions[:, i], rewards[:, i], next_states[:, i], dones[:, i])